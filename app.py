@@ -11,35 +11,17 @@ import io # export de donnees
 import os #chemin relatif des fichiers
 from pathlib import Path
 from io import BytesIO #referentiel
+import threading # pré-chargement du cache cadastre
+import proxy_cadastre # proxy WMS avec cache disque
+import json # export SIG
+import referentiel # versions du référentiel
+from referentiel import traduire_statut, classes_enjeu, couleurs_enjeu, classer_enjeu, get_indice_global_color
+import observations # ingestion des observations
+import fiches_especes # fiches imprimables
+import taches_export # exports en arrière-plan
 
 # --------------------- FONCTIONS ---------------------
 
-# Fonction pour traduire les statuts codés en libellés compréhensibles
-def traduire_statut(statut):
-    traductions = {
-            "VU": "Vulnérable",
-            "EN": "En danger",
-            "CR": "En danger critique",
-            "NT": "Quasi menacé",
-            "LC": "Préoccupation mineure",
-            "DD": "Données insuffisantes",
-            "RE": "Éteint régionalement",
-            "NA": "Non applicable (Non indigène ou données occasionnelles)",
-            "NE": "Non évalué",
-            "DH IV": "Directive Habitats, Faune, Flore - Annexe IV",
-            "DH II&IV": "Directive Habitats, Faune, Flore - Annexe II & IV",
-            "DO I": "Directive Oiseaux - Annexe I",
-            "N.C." : "Non Concerné",
-            "PRA en cours" : "Plan régional d'action en cours",
-            "PNA en cours" : "Plan national d'action en cours",
-            "PRA en préparation" : "Plan régional d'action en préparation",
-            "PNA en préparation" : "Plan national d'action en préparation",
-            "PNG en cours" : "Plan national de gestion en cours",
-            "PRA en cours + PNA en préparation" : "Plan régional d'action en cours + Plan national d'action en préparation"}
-                    
-    return traductions.get(statut, statut) # Retourne le statut traduit ou le statut d'origine si non trouvé            
-
-
 # Fonction de reset global
 def reset_all():
     st.session_state.selected_foret = None
@@ -48,44 +30,6 @@ def reset_all():
     st.session_state.reset_requested = True
 
 
-#Fonction d'affichage du fond
-def get_indice_global_color(val):
-    try:
-        v = float(val)
-        if 0 <= v <= 2:
-            return '#92D050'  # vert
-        elif 3 <= v <= 8:
-            return '#FFFF00'  # jaune
-        elif 9 <= v <= 12:
-            return '#FFC000'  # orange
-        elif 13 <= v <= 16:
-            return '#FF0000'  # rouge
-        elif 17 <= v <= 20:
-            return '#C00000'  # marron
-    except:
-        return '#ffffff'
-    return '#ffffff'
-
-
-#Fonction d'affichage des points naturalistes par couleur
-def get_indice_global_color_row(row):
-    try:
-        v = float(row)
-        if 0 <= v <= 2:
-            return '#92D050'  # vert
-        elif 3 <= v <= 8:
-            return '#FFFF00'  # jaune
-        elif 9 <= v <= 12:
-            return '#FFC000'  # orange
-        elif 13 <= v <= 16:
-            return '#FF0000'  # rouge
-        elif 17 <= v <= 20:
-            return '#C00000'  # marron
-    except:
-        return '#ffffff'
-    return '#ffffff'
-
-
 #Pour enlever sécuriser l'affichage des popus qui sinon peuvent faire bugger la carte
 def safe_get(val):
     if pd.isna(val) or val in ["nan", "NaN", None]:
@@ -97,11 +41,179 @@ def safe_get(val):
     return val_str
 
 
-# Fonction d'affichage des cartes
-def afficher_carte(df, df_reference, titre="📍 Localisation des espèces "):
-    if df.empty:
-        st.warning("Aucune donnée à afficher pour cette sélection.")
-        return
+# Conversion approximative degrés → mètres (suffisante à l'échelle d'une forêt)
+m_par_degre_lat = 110540
+m_par_degre_lon = 111320
+
+
+# Fonction d'affectation vectorisée des observations à une maille carrée ou hexagonale de "taille" mètres
+# (côté du carré ou rayon de l'hexagone) ; retourne la position du centre de la maille de chaque observation.
+# lat_ref est la latitude de référence de la projection locale (la latitude moyenne de la forêt)
+def calculer_mailles(lon, lat, lat_ref, forme="hexagone", taille=100):
+    facteur_lon = m_par_degre_lon * np.cos(np.radians(lat_ref))
+    x = np.asarray(lon, dtype=float) * facteur_lon
+    y = np.asarray(lat, dtype=float) * m_par_degre_lat
+    if forme == "hexagone":
+        # Coordonnées axiales (hexagones pointe en haut) puis arrondi à l'hexagone le plus proche
+        q = (np.sqrt(3) / 3 * x - y / 3) / taille
+        r = (2 / 3 * y) / taille
+        s = -q - r
+        q_arr, r_arr, s_arr = np.round(q), np.round(r), np.round(s)
+        ecart_q, ecart_r, ecart_s = np.abs(q_arr - q), np.abs(r_arr - r), np.abs(s_arr - s)
+        corriger_q = (ecart_q > ecart_r) & (ecart_q > ecart_s)
+        corriger_r = ~corriger_q & (ecart_r > ecart_s)
+        q_arr = np.where(corriger_q, -r_arr - s_arr, q_arr)
+        r_arr = np.where(corriger_r, -q_arr - s_arr, r_arr)
+        centre_x = taille * np.sqrt(3) * (q_arr + r_arr / 2)
+        centre_y = taille * 1.5 * r_arr
+    else:
+        centre_x = (np.floor(x / taille) + 0.5) * taille
+        centre_y = (np.floor(y / taille) + 0.5) * taille
+    return centre_x / facteur_lon, centre_y / m_par_degre_lat
+
+
+# Fonction de calcul du contour d'une maille (liste de [lat, lon]) à partir de son centre
+def contour_maille(lon, lat, forme="hexagone", taille=100):
+    facteur_lon = m_par_degre_lon * np.cos(np.radians(lat))
+    if forme == "hexagone":
+        angles = np.radians(30 + 60 * np.arange(6))
+        decalages = zip(taille * np.cos(angles), taille * np.sin(angles))
+    else:
+        demi = taille / 2
+        decalages = [(-demi, -demi), (demi, -demi), (demi, demi), (-demi, demi)]
+    return [[lat + dy / m_par_degre_lat, lon + dx / facteur_lon] for dx, dy in decalages]
+
+
+# Fonction de synthèse des observations par maille : espèces, indice d'enjeu maximal, nombre d'observations et dernière date
+def resumer_mailles(df):
+    df = df.dropna(subset=["Maille_lon", "Maille_lat"]).assign(Indice=pd.to_numeric(df["Indice_global"], errors="coerce"))
+    return df.groupby(["Forêt", "Maille_lon", "Maille_lat"], sort=True).agg(
+        Especes=("Espèce", lambda s: ", ".join(sorted(s.dropna().astype(str).unique()))),
+        Indice_max=("Indice", "max"),
+        Nb_observations=("Espèce", "size"),
+        Derniere_observation=("Date_obs", "max"),
+    ).reset_index(level=["Maille_lon", "Maille_lat"])
+
+
+# Formats de l'export SIG : (extension, type MIME)
+formats_sig = {
+    "GeoPackage": ("gpkg", "application/geopackage+sqlite3"),
+    "GeoJSON": ("geojson", "application/geo+json"),
+}
+
+
+# Fonction de conversion d'un bloc d'observations en couche de points WGS84
+def bloc_vers_geodataframe(bloc):
+    bloc = bloc.copy()
+    # Colonnes texte homogènes d'un bloc à l'autre (les colonnes mixtes texte/nombre font échouer l'écriture par blocs)
+    for col in bloc.columns:
+        if bloc[col].dtype == object or pd.api.types.is_string_dtype(bloc[col]):
+            bloc[col] = bloc[col].map(lambda v: None if pd.isna(v) else str(v)).astype(object)
+    geometrie = gpd.points_from_xy(bloc["Coordonnée 1"], bloc["Coordonnée 2"])
+    return gpd.GeoDataFrame(bloc, geometry=geometrie, crs="EPSG:4326")
+
+
+# Fonction d'écriture de l'export SIG par blocs directement dans le fichier destination
+# (mémoire bornée quelle que soit la taille de l'export ; une sélection vide donne une couche vide)
+def ecrire_export_sig(df_export, format_sig, destination, taille_bloc=5000, avancer=None):
+    nb = max(len(df_export), 1)
+
+    if format_sig == "GeoJSON":
+        with open(destination, "w", encoding="utf-8") as flux:
+            flux.write('{"type": "FeatureCollection", "features": [\n')
+            premier = True
+            for debut in range(0, len(df_export), taille_bloc):
+                for entite in bloc_vers_geodataframe(df_export.iloc[debut:debut + taille_bloc]).iterfeatures(na="null", drop_id=True):
+                    flux.write(("" if premier else ",\n") + json.dumps(entite, ensure_ascii=False, default=str))
+                    premier = False
+                if avancer:
+                    avancer(min(debut + taille_bloc, nb) / nb, "Écriture des entités")
+            flux.write("\n]}\n")
+    else:
+        # GeoPackage écrit par ajouts successifs (le premier bloc, éventuellement vide, crée la couche)
+        for debut in range(0, nb, taille_bloc):
+            bloc_vers_geodataframe(df_export.iloc[debut:debut + taille_bloc]).to_file(
+                destination, layer="export_amenagement", driver="GPKG", mode="w" if debut == 0 else "a"
+            )
+            if avancer:
+                avancer(min(debut + taille_bloc, nb) / nb, "Écriture des entités")
+
+
+# Fonction d'écriture de l'export aménagement xlsx (notice puis observations, écrites par blocs pour suivre l'avancement)
+def ecrire_export_xlsx(df_export, df_notice, taille_bloc=5000, avancer=None):
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        df_notice.to_excel(writer, sheet_name="Notice", index=False)
+        for debut in range(0, max(len(df_export), 1), taille_bloc):
+            df_export.iloc[debut:debut + taille_bloc].to_excel(
+                writer, sheet_name="Export aménagement", index=False,
+                startrow=debut + 1 if debut else 0, header=debut == 0
+            )
+            if avancer:
+                avancer(min(debut + taille_bloc, len(df_export)) / max(len(df_export), 1), "Écriture des observations")
+        if avancer:
+            avancer(1, "Compression du classeur")
+    return buffer.getvalue()
+
+
+# Fonction d'écriture du référentiel mis en forme (couleurs par catégorie et par indice) au format xlsx
+def ecrire_referentiel_xlsx(styled_df, avancer=None):
+    output = BytesIO()
+    if avancer:
+        avancer(0.1, "Mise en forme du référentiel")
+    styled_df.to_excel(output, engine='openpyxl', index=False)
+    return output.getvalue()
+
+
+# File des exports exécutés en arrière-plan, partagée par toutes les sessions
+@st.cache_resource
+def file_exports():
+    return taches_export.FileTaches(nb_travailleurs=TRAVAILLEURS_EXPORT)
+
+
+# Suivi d'un export en cours : la barre de progression est rafraîchie chaque seconde sans recharger la page,
+# puis la page est rechargée une fois l'export terminé pour afficher le bouton de téléchargement
+@st.fragment(run_every=1)
+def suivre_export(tache):
+    if not tache.active:
+        st.rerun()
+    st.progress(tache.progression, text=f"{tache.libelle} : {tache.message}")
+
+
+# Fonction d'affichage d'un export exécuté en arrière-plan : bouton de lancement, progression pendant le calcul,
+# puis bouton de téléchargement. Le résultat est partagé entre les sessions qui demandent le même export (même clé).
+# vers_fichier : la fonction écrit elle-même dans le fichier du résultat (argument destination)
+def bouton_export(cle, libelle, nom_fichier, mime, key, fonction, *args, vers_fichier=False):
+    file = file_exports()
+    tache = file.tache(cle)
+    # Résultat évincé du cache depuis son calcul : l'export est relancé plutôt que d'afficher un bouton sans fichier
+    if tache is not None and tache.etat == taches_export.TERMINEE and not tache.disponible:
+        tache = file.soumettre(cle, libelle, fonction, *args, vers_fichier=vers_fichier)
+    if tache is None or tache.etat == taches_export.ECHEC:
+        if tache is not None:
+            st.error(f"Échec de l'export : {tache.erreur}")
+        if not st.button(libelle, key=key):
+            return
+        tache = file.soumettre(cle, libelle, fonction, *args, vers_fichier=vers_fichier)
+    if tache.active:
+        suivre_export(tache)
+    else:
+        st.download_button(
+            label=f"{libelle} ⬇️",
+            data=tache.lire,
+            file_name=nom_fichier,
+            mime=mime,
+            key=f"{key}_telechargement"
+        )
+
+
+# Préparation des tables fusionnées et de l'export d'une sélection (forêt, parcelle, période).
+# La clé de cache inclut l'empreinte des seules espèces de la sélection dans le référentiel :
+# une correction du référentiel ne recalcule que les sélections qui contiennent une espèce modifiée.
+@st.cache_data(max_entries=64, show_spinner=False)
+def preparer_carte_export(cle_selection, empreinte, brutes, _df, _df_reference):
+    df = _df.join(mailles_observations)
+    df_reference = _df_reference
 
     # Fusion avec la table de référence via CD_NOM
     df = df.rename(columns={"Code taxon (cd_nom)": "CD_NOM"})
@@ -110,8 +222,17 @@ def afficher_carte(df, df_reference, titre="📍 Localisation des espèces "):
         on="CD_NOM", how="left"
     )
 
+    # Synthèse par maille : celle précalculée à l'ingestion pour une forêt entière sans filtre de période,
+    # sinon calculée sur la sélection à partir des mailles affectées à l'ingestion
+    foret, parcelle, periode, enjeu_minimal, categories = cle_selection or (None, None, None, None, ())
+    selection_complete = parcelle is None and periode is None and enjeu_minimal in (None, classes_enjeu[0]) and not categories
+    if selection_complete and foret in resume_mailles.index:
+        df_mailles = resume_mailles.loc[[foret]]
+    else:
+        df_mailles = resumer_mailles(df_popup)
+
     # Colonnes à afficher
-    colonnes_a_afficher = ['Forêt', 'CD_NOM', 'Date début', 'Espèce', 'Commentaire du relevé', 'Commentaire de la localisation', "Commentaire de l'observation", 'Parcelle de forêt', 'Surface de la géométrie', 'Coordonnée 1', 'Coordonnée 2', 'Système de coordonnées', 'Observateur(s)', "Fiabilité de l'observation", "Statut juridique"]
+    colonnes_a_afficher = ['Forêt', 'CD_NOM', 'Date début', 'Espèce', 'Commentaire du relevé', 'Commentaire de la localisation', "Commentaire de l'observation", 'Parcelle de forêt', 'Surface de la géométrie', 'Coordonnée 1', 'Coordonnée 2', 'Système de coordonnées', 'Observateur(s)', "Fiabilité de l'observation", "Statut juridique", "Nb_doublons"]
     
     df_fusion = df[colonnes_a_afficher].merge(
         df_reference[["CD_NOM"]],
@@ -122,8 +243,8 @@ def afficher_carte(df, df_reference, titre="📍 Localisation des espèces "):
     colonnes_reference = [
         "Cat_naturaliste", "Nom_scientifique_valide", "LR_nat", "LR_reg",
         "Indice_global",
-        "Directives_euro", "Plan_action", "Arrêté_protection_nationale", "Arrêté_protection_BN",
-        "Arrêté_protection_HN", "Article_arrêté", "Type_protection", "Conseils_gestion"
+        "Directives_euro", "Plan_action", *referentiel.colonnes_protection(df_reference),
+        "Article_arrêté", "Type_protection", "Conseils_gestion"
     ]
 
     df_export = df_fusion.merge(
@@ -131,6 +252,18 @@ def afficher_carte(df, df_reference, titre="📍 Localisation des espèces "):
         on="CD_NOM", how="left"
     )
 
+    return df_popup, df_mailles, df_export
+
+
+# Fonction d'affichage des cartes
+def afficher_carte(df, df_reference, titre="📍 Localisation des espèces ", cle_selection=None):
+    if df.empty:
+        st.warning("Aucune donnée à afficher pour cette sélection.")
+        return
+
+    empreinte = referentiel.empreinte_selection(empreintes_especes, df["Code taxon (cd_nom)"])
+    df_popup, df_mailles, df_export = preparer_carte_export(cle_selection, empreinte, observations_brutes, df, df_reference)
+
     # Astuce CSS pour limiter la hauteur au chargement
     st.markdown("""
         <style>
@@ -150,8 +283,8 @@ def afficher_carte(df, df_reference, titre="📍 Localisation des espèces "):
 
     # Ajout du fond de carte cadastre (WMS IGN)
     folium.raster_layers.WmsTileLayer(
-        url="https://data.geopf.fr/wms-r/wms",
-        layers="CADASTRALPARCELS.PARCELLAIRE_EXPRESS",
+        url=url_cadastre,
+        layers=proxy_cadastre.COUCHE_CADASTRE,
         name="Cadastre",
         fmt="image/png",
         transparent=True,
@@ -160,40 +293,58 @@ def afficher_carte(df, df_reference, titre="📍 Localisation des espèces "):
         control=True
     ).add_to(m)
 
-    # Ajout des points naturalistes
-    for _, row in df_popup.iterrows():
-        if pd.notna(row["Coordonnée 1"]) and pd.notna(row["Coordonnée 2"]):
-            couleur = get_indice_global_color_row(row["Indice_global"])
-
-            popup = f"""<b>Parcelle :</b> {safe_get(row.get('Parcelle de forêt'))}<br>
-            <b>Espèce :</b> {safe_get(row.get('Espèce'))}<br>
-            <b>Commentaire de la localisation :</b> {safe_get(row.get('Commentaire de la localisation'))}<br>
-            <b>Commentaire de l'observation :</b> {safe_get(row.get("Commentaire de l'observation"))}<br>
-            <b>Commentaire du relevé :</b> {safe_get(row.get("Commentaire du relevé"))}<br>
-            <b>Date d'observation :</b> {safe_get(row.get("Date début"))}<br>
-            <b>Surface de la géométrie :</b> {row["Surface de la géométrie"]}<br>
-            <b>Système de coordonnées :</b> {safe_get(row.get("Système de coordonnées"))}<br>
+    # Ajout des mailles agrégées (par défaut) ou des points naturalistes (à la demande)
+    points_bruts = st.session_state.get("carte_points_bruts", False)
+    if points_bruts:
+        for _, row in df_popup.iterrows():
+            if pd.notna(row["Coordonnée 1"]) and pd.notna(row["Coordonnée 2"]):
+                couleur = couleurs_enjeu.get(row["Classe_enjeu"], '#ffffff')
+
+                popup = f"""<b>Parcelle :</b> {safe_get(row.get('Parcelle de forêt'))}<br>
+                <b>Espèce :</b> {safe_get(row.get('Espèce'))}<br>
+                <b>Commentaire de la localisation :</b> {safe_get(row.get('Commentaire de la localisation'))}<br>
+                <b>Commentaire de l'observation :</b> {safe_get(row.get("Commentaire de l'observation"))}<br>
+                <b>Commentaire du relevé :</b> {safe_get(row.get("Commentaire du relevé"))}<br>
+                <b>Date d'observation :</b> {safe_get(row.get("Date début"))}<br>
+                <b>Observateur(s) :</b> {safe_get(row.get("Observateur(s)"))}<br>
+                {f"<b>Doublons regroupés :</b> {row['Nb_doublons']}<br>" if row.get("Nb_doublons", 0) > 0 else ""}
+                <b>Surface de la géométrie :</b> {row["Surface de la géométrie"]}<br>
+                <b>Système de coordonnées :</b> {safe_get(row.get("Système de coordonnées"))}<br>
+                """
+
+                folium.CircleMarker(
+                    location=[row["Coordonnée 2"], row["Coordonnée 1"]],
+                    radius=6,
+                    color="black",
+                    weight=1,
+                    fill=True,
+                    fill_color=couleur,
+                    fill_opacity=1,
+                    popup=folium.Popup(popup, max_width=500)
+                ).add_to(m)
+    else:
+        for _, maille in df_mailles.iterrows():
+            couleur = get_indice_global_color(maille["Indice_max"])
+
+            popup = f"""<b>Espèces :</b> {safe_get(maille["Especes"])}<br>
+            <b>Indice d'enjeu global maximal :</b> {safe_get(maille["Indice_max"])}<br>
+            <b>Nombre d'observations :</b> {maille["Nb_observations"]}<br>
+            <b>Dernière observation :</b> {safe_get(maille["Derniere_observation"])}<br>
             """
 
-            folium.CircleMarker(
-                location=[row["Coordonnée 2"], row["Coordonnée 1"]],
-                radius=6,
+            folium.Polygon(
+                locations=contour_maille(maille["Maille_lon"], maille["Maille_lat"], FORME_MAILLE, TAILLE_MAILLE),
                 color="black",
                 weight=1,
                 fill=True,
                 fill_color=couleur,
-                fill_opacity=1,
+                fill_opacity=0.8,
                 popup=folium.Popup(popup, max_width=500)
             ).add_to(m)
 
     # Contrôle de couches
     folium.LayerControl().add_to(m)
 
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-        df_notice_am.to_excel(writer, sheet_name="Notice", index=False)
-        df_export.to_excel(writer, sheet_name="Export aménagement", index=False)
-
     # Affichage dans Streamlit
     with st.container():
         st.markdown(f"### {titre}")
@@ -238,27 +389,169 @@ def afficher_carte(df, df_reference, titre="📍 Localisation des espèces "):
             """, unsafe_allow_html=True)
 
         with col2:
-            st.download_button(
-                label="📥 Export aménagement",
-                data=buffer.getvalue(),
-                file_name="export_amenagement.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                key="download_xlsx_amenagement"
+            # Exports générés au clic en arrière-plan (réutilisés tant que la sélection et ses espèces ne changent pas)
+            bouton_export(
+                ("amenagement", cle_selection, empreinte, observations_brutes), "📥 Export aménagement",
+                "export_amenagement.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                "download_xlsx_amenagement", ecrire_export_xlsx, df_export, df_notice_am
             )
+            format_sig = st.selectbox("Format SIG", list(formats_sig), key="format_export_sig", label_visibility="collapsed")
+            bouton_export(
+                ("sig", format_sig, cle_selection, empreinte, observations_brutes), "🗺️ Export SIG",
+                f"export_amenagement.{formats_sig[format_sig][0]}", formats_sig[format_sig][1],
+                "download_sig_amenagement", ecrire_export_sig, df_export, format_sig, vers_fichier=True
+            )
+            st.toggle("Afficher chaque observation", value=False, key="carte_points_bruts")
 
         st_folium(m, height=600, returned_objects=[], use_container_width=True)
 
 
+# Colonnes du tableau des observations (les commentaires, volumineux, ne sont chargés qu'à la demande)
+colonnes_tableau = ['Forêt', 'Code taxon (cd_nom)', 'Date début', 'Espèce', 'Classe_enjeu', 'Parcelle de forêt', 'Surface de la géométrie', 'Coordonnée 1', 'Coordonnée 2', 'Système de coordonnées', 'Observateur(s)', "Fiabilité de l'observation", "Statut juridique", "Nb_doublons"]
+colonnes_commentaires = ['Commentaire du relevé', 'Commentaire de la localisation', "Commentaire de l'observation"]
+
+
+# Fonction de sélection des observations d'une période par recherche dichotomique
+# (le tableau doit être trié par "Date_obs", les dates manquantes en fin, ce qui est le cas de chaque forêt et de ses parcelles)
+def bornes_periode(dates, periode):
+    debut = np.datetime64(pd.Timestamp(periode[0]), "ns")
+    fin = np.datetime64(pd.Timestamp(periode[1]) + pd.Timedelta(days=1), "ns")
+    dates = dates.to_numpy(dtype="datetime64[ns]")
+    return np.searchsorted(dates, debut, side="left"), np.searchsorted(dates, fin, side="left")
+
+
+# Fonction de filtrage côté serveur du tableau des observations : retourne les positions des lignes retenues
+def filtrer_observations(df, especes=None, periode=None, observateur="", fiabilites=None):
+    masque = np.ones(len(df), dtype=bool)
+    if periode:
+        i, j = bornes_periode(df["Date_obs"], periode)
+        masque[:i] = False
+        masque[j:] = False
+    if especes:
+        masque &= df["Espèce"].isin(especes).to_numpy()
+    if observateur:
+        masque &= df["Observateur(s)"].astype(str).str.contains(observateur, case=False, regex=False, na=False).to_numpy()
+    if fiabilites:
+        masque &= df["Fiabilité de l'observation"].isin(fiabilites).to_numpy()
+    return np.flatnonzero(masque)
+
+
+# Fonction de tri et pagination côté serveur : retourne les positions des lignes de la page demandée
+def paginer_observations(df, positions, tri="Date début", croissant=False, page=1, taille_page=50):
+    # Tri sur la seule colonne demandée (les colonnes mixtes texte/nombre sont comparées en texte)
+    valeurs = df[tri].iloc[positions].reset_index(drop=True)
+    cle_tri = (lambda s: s.astype(str)) if valeurs.dtype == object else None
+    ordre = valeurs.sort_values(ascending=croissant, na_position="last", kind="stable", key=cle_tri).index.to_numpy()
+    debut = (page - 1) * taille_page
+    return positions[ordre[debut:debut + taille_page]]
+
+
+# Fonction d'affichage du tableau paginé des observations
+def afficher_tableau_observations(df_filtré, cle="observations"):
+    with st.expander("🔧 Filtres et tri du tableau"):
+        col1, col2 = st.columns(2)
+        with col1:
+            especes = st.multiselect("Espèces", sorted(df_filtré["Espèce"].dropna().astype(str).unique()), key=f"{cle}_especes")
+            observateur = st.text_input("Observateur(s) contient", key=f"{cle}_observateur")
+            fiabilites = st.multiselect("Fiabilité de l'observation", sorted(df_filtré["Fiabilité de l'observation"].dropna().astype(str).unique()), key=f"{cle}_fiabilite")
+        with col2:
+            dates = df_filtré["Date_obs"].dropna()
+            periode = None
+            if not dates.empty:
+                periode = st.date_input("Période d'observation", value=(dates.min().date(), dates.max().date()), key=f"{cle}_periode")
+                periode = periode if len(periode) == 2 else None
+            tri = st.selectbox("Trier par", colonnes_tableau, index=colonnes_tableau.index("Date début"), key=f"{cle}_tri")
+            croissant = st.toggle("Ordre croissant", value=False, key=f"{cle}_croissant")
+        commentaires = st.toggle("Afficher les commentaires", value=False, key=f"{cle}_commentaires")
+
+    col1, col2 = st.columns([1, 1])
+    with col2:
+        taille_page = st.selectbox("Lignes par page", [25, 50, 100, 200], index=1, key=f"{cle}_taille_page")
+    positions = filtrer_observations(df_filtré, especes, periode, observateur, fiabilites)
+    total = len(positions)
+    nb_pages = max(1, -(-total // taille_page))
+    with col1:
+        page = st.number_input(f"Page (sur {nb_pages})", min_value=1, max_value=nb_pages, value=1, step=1, key=f"{cle}_page")
+    page = min(page, nb_pages)
+
+    positions = paginer_observations(df_filtré, positions, tri, croissant, page, taille_page)
+
+    # Projection : seules les colonnes visibles des lignes de la page sont envoyées au navigateur
+    colonnes = colonnes_tableau + (colonnes_commentaires if commentaires else [])
+    st.dataframe(df_filtré.iloc[positions][colonnes], hide_index=True)
+    st.caption(f"{total} observation(s) — lignes {min((page - 1) * taille_page + 1, total)} à {min(page * taille_page, total)}")
+
+
+# Occurrences d'une espèce dans l'index inversé (parcelles), vide si l'espèce n'a jamais été observée
+def occurrences_espece(index_especes, cd_nom):
+    try:
+        return index_especes.xs(cd_nom, level=0)
+    except KeyError:
+        return index_especes.iloc[0:0].droplevel(0)
+
+
+# Fonction d'affichage des forêts et parcelles où une espèce a été observée
+def afficher_occurrences_espece(occurrences):
+    st.markdown("---")
+    st.subheader("📍 Forêts et parcelles où l'espèce a été observée")
+    if occurrences.empty:
+        st.info("Aucune observation de cette espèce dans les forêts.")
+        return
+
+    par_foret = occurrences.groupby(level="Forêt", observed=True).agg(
+        Nb_parcelles=("Nb_observations", "size"),
+        Nb_observations=("Nb_observations", "sum"),
+        Derniere_observation=("Derniere_observation", "max"),
+    ).sort_values("Nb_observations", ascending=False)
+    st.markdown(f"**{len(par_foret)} forêt(s), {len(occurrences)} parcelle(s), {int(par_foret['Nb_observations'].sum())} observation(s)**")
+    st.dataframe(par_foret)
+    with st.expander("Détail par parcelle"):
+        st.dataframe(occurrences[["Nb_observations", "Derniere_observation"]])
+
+    # Carte : un point par parcelle, placé à la position moyenne des observations
+    points = occurrences.dropna(subset=["Longitude", "Latitude"])
+    if not points.empty:
+        m = folium.Map(location=[points["Latitude"].mean(), points["Longitude"].mean()], zoom_start=8, control_scale=True)
+        for (foret, parcelle), ligne in points.iterrows():
+            popup = f"""<b>Forêt :</b> {safe_get(foret)}<br>
+            <b>Parcelle :</b> {safe_get(parcelle)}<br>
+            <b>Nombre d'observations :</b> {ligne["Nb_observations"]}<br>
+            <b>Dernière observation :</b> {safe_get(ligne["Derniere_observation"])}<br>
+            """
+            folium.CircleMarker(
+                location=[ligne["Latitude"], ligne["Longitude"]],
+                radius=6,
+                color="black",
+                weight=1,
+                fill=True,
+                fill_color="#2E7D32",
+                fill_opacity=1,
+                popup=folium.Popup(popup, max_width=500)
+            ).add_to(m)
+        st_folium(m, height=500, returned_objects=[], use_container_width=True)
+
+
+# Fiche d'une espèce dans le référentiel, mise en cache selon l'empreinte de l'espèce (recalculée uniquement si elle change)
+@st.cache_data(max_entries=1000, show_spinner=False)
+def fiche_espece(cd_nom, empreinte, _df_reference):
+    return _df_reference[_df_reference['CD_NOM'] == cd_nom]
+
+
 # Fonction d'affichage des statuts et prescriptions
-def afficher_statuts_prescriptions(df_filtré, df_reference):
+def afficher_statuts_prescriptions(df_filtré, df_reference, titre="Espèces remarquables"):
     if df_filtré.empty:
         st.warning("Aucune espèce à afficher pour cette sélection.")
         return
 
-    # Colonnes à afficher
-    colonnes_a_afficher = ['Forêt', 'Code taxon (cd_nom)', 'Date début', 'Espèce', 'Commentaire du relevé', 'Commentaire de la localisation', "Commentaire de l'observation", 'Parcelle de forêt', 'Surface de la géométrie', 'Coordonnée 1', 'Coordonnée 2', 'Système de coordonnées', 'Observateur(s)', "Fiabilité de l'observation", "Statut juridique"]
+    afficher_tableau_observations(df_filtré)
 
-    st.dataframe(df_filtré[colonnes_a_afficher])
+    # Fiches imprimables de toutes les espèces de la sélection (générées au clic en arrière-plan, seules les fiches modifiées sont re-rendues)
+    codes_selection = df_filtré['Code taxon (cd_nom)'].unique().tolist()
+    bouton_export(
+        ("fiches", titre, referentiel.empreinte_selection(empreintes_especes, codes_selection)),
+        "🖨️ Fiches imprimables des espèces (.html)", "fiches_especes.html", "text/html",
+        "download_fiches_especes", fiches_especes.generer_document, df_reference, codes_selection, titre
+    )
 
     # Création d’un mapping lisible : {cd_nom: "Espèce"}
     df_temp = df_filtré[['Code taxon (cd_nom)', 'Espèce']].dropna()
@@ -288,8 +581,7 @@ def afficher_statuts_prescriptions(df_filtré, df_reference):
 
     if selected_species:
         selected_species = str(selected_species).strip()
-        df_reference['CD_NOM'] = df_reference['CD_NOM'].astype(str).str.strip()
-        species_reference_info = df_reference[df_reference['CD_NOM'] == selected_species]
+        species_reference_info = fiche_espece(selected_species, empreintes_especes.get(selected_species), df_reference)
         st.markdown("")
         st.subheader(f"📘 Statuts et prescriptions : {selected_label}")
 
@@ -369,13 +661,10 @@ def afficher_statuts_prescriptions(df_filtré, df_reference):
                 st.write(f"**Responsabilité régionale :** {texte_respo}")
                 st.write(f"**Directives européennes :** {traduire_statut(species_reference_info['Directives_euro'].iloc[0])}")
                 st.write(f"**Plan d'action :** {traduire_statut(species_reference_info['Plan_action'].iloc[0])}")
-                # Récupération des 3 colonnes concernées
-                apn = species_reference_info['Arrêté_protection_nationale'].iloc[0]
-                ap_bn = species_reference_info['Arrêté_protection_BN'].iloc[0]
-                ap_hn = species_reference_info['Arrêté_protection_HN'].iloc[0]
+                # Récupération des colonnes d'arrêtés de protection (national et régionaux)
+                valeurs_protection = [species_reference_info[col].iloc[0] for col in referentiel.colonnes_protection(df_reference)]
 
                 # On filtre uniquement les valeurs différentes de "N.C."
-                valeurs_protection = [apn, ap_bn, ap_hn]
                 valeurs_non_nc = [v for v in valeurs_protection if str(v).strip() != "N.C."]
 
                 # Affichage
@@ -398,21 +687,12 @@ def afficher_statuts_prescriptions(df_filtré, df_reference):
 
 # Fonction de mise en forme conditionnelle du réferentiel pour la colonne "indice_global"
 def color_indice(val):
-    try:
-        v = float(val)
-    except:
+    couleur = get_indice_global_color(val)
+    if couleur == '#ffffff':
         return ''
-    if 0 <= v <= 2:
-        return 'background-color: #92D050'
-    elif 4 <= v <= 8:
-        return 'background-color: #FFFF00'
-    elif 10 <= v <= 12:
-        return 'background-color: #FFC000'
-    elif 14 <= v <= 16:
-        return 'background-color: #FF0000'
-    elif 18 <= v <= 20:
-        return 'background-color: #C00000; color: white'
-    return ''
+    if couleur == couleurs_enjeu["Enjeu majeur"]:
+        return f'background-color: {couleur}; color: white'
+    return f'background-color: {couleur}'
 
 
 # Fonction de mise en forme du reéférentiel ligne par ligne selon "Cat_naturaliste"
@@ -431,6 +711,23 @@ def color_by_cat(df):
 # Définition de la configuration de la page Streamlit
 st.set_page_config(page_title="Espèces remarquables et prescriptions", page_icon="🦋", layout="wide")
 
+# Proxy cadastre déjà démarré par ailleurs (python proxy_cadastre.py --hote 0.0.0.0 ...) : adresse vue par le navigateur.
+# Lorsqu'elle est renseignée, la carte utilise ce proxy et l'application n'en démarre aucun
+URL_PROXY_EXTERNE = os.environ.get("CADASTRE_PROXY_URL")
+# Proxy avec cache disque démarré par l'application (optionnel, activé par CADASTRE_PROXY=1) ;
+# il n'écoute que sur la machine locale (pour des navigateurs distants, utiliser un proxy externe)
+PROXY_CADASTRE = os.environ.get("CADASTRE_PROXY", "0") == "1" and not URL_PROXY_EXTERNE
+PORT_PROXY_CADASTRE = int(os.environ.get("CADASTRE_PROXY_PORT", "8765"))
+# Pré-chargement des tuiles de chaque forêt au démarrage du proxy (CADASTRE_PRECHARGEMENT=1)
+PRECHARGEMENT_CADASTRE = os.environ.get("CADASTRE_PRECHARGEMENT", "0") == "1"
+
+# Maillage d'agrégation des observations sur la carte : forme ("hexagone" ou "carre") et taille en mètres
+FORME_MAILLE = os.environ.get("MAILLE_FORME", "hexagone")
+TAILLE_MAILLE = float(os.environ.get("MAILLE_TAILLE", "100"))
+
+# Nombre d'exports (xlsx, SIG, fiches) calculés simultanément en arrière-plan
+TRAVAILLEURS_EXPORT = int(os.environ.get("EXPORT_TRAVAILLEURS", "2"))
+
 
 # --------------------- AUTHENTIFICATION --------------
 
@@ -540,22 +837,20 @@ if st.session_state.authenticated:
     # Chargement du fichier principal contenant les observations de la Base de données naturalistes de l'ONF
     @st.cache_data
     def load_data():
-        file_path = Path(__file__).parent / "MonExportBdn.xlsx"
-        return pd.read_excel(file_path)
+        return observations.lire_observations()
 
-    # Chargement de la liste des codes CD_NOM autorisés (filtrage pour avoir uniquement les espèces du tableau de métadonnées des espèces remarquables)
+    # Chargement du catalogue des forêts du stockage partitionné (vide si le stockage n'a pas été constitué)
     @st.cache_data
-    def load_codes_autorises():
-        file_path = Path(__file__).parent / "Metadonnees.xlsx"
-        df_codes = pd.read_excel(file_path)
-        return df_codes['CD_NOM'].astype(str).str.strip().tolist()
+    def load_catalogue(date_modification):
+        return observations.lire_catalogue()
 
     # Chargement du fichier de référence des espèces avec leurs métadonnées
+    # (rechargé uniquement si le fichier est modifié ; chaque nouvelle version est enregistrée)
     @st.cache_data
-    def load_reference_especes():
-        file_path = Path(__file__).parent / "Metadonnees.xlsx"
-        df_reference = pd.read_excel(file_path, keep_default_na=False)
-        return df_reference
+    def load_reference_especes(chemin, date_modification, dossier_versions):
+        df_reference = referentiel.lire_referentiel(chemin)
+        version = referentiel.enregistrer_version(df_reference, dossier_versions)
+        return df_reference, version, referentiel.empreintes_especes(df_reference)
 
     # Chargement de la notice de l'export aménagement
     @st.cache_data
@@ -570,20 +865,168 @@ if st.session_state.authenticated:
         return pd.read_excel(file_path)
     
 
+    # Préparation des observations à l'ingestion (une seule fois pour toutes les sessions)
+    # (ne dépend du référentiel que par la liste des codes CD_NOM autorisés).
+    # En stockage partitionné, seule la partition (région, forêt) consultée est chargée.
+    # Les doublons sont regroupés, sauf si les observations brutes sont demandées
+    @st.cache_data(max_entries=16)
+    def preparer_observations(codes_autorises, partition=None, brutes=False):
+        if partition is None:
+            return observations.preparer(load_data(), codes_autorises, consolidation=not brutes)
+        return observations.preparer(observations.lire_partition(*partition), codes_autorises, consolidation=not brutes)
+
+
+    # Affectation de chaque observation à une maille d'agrégation (projection locale centrée sur la latitude moyenne de sa forêt)
+    @st.cache_data(max_entries=16)
+    def load_mailles_observations(codes_autorises, forme, taille, partition=None, brutes=False):
+        df = preparer_observations(codes_autorises, partition, brutes)[0]
+        lat_ref = df.groupby("Forêt")["Coordonnée 2"].transform("mean").fillna(df["Coordonnée 2"])
+        maille_lon, maille_lat = calculer_mailles(df["Coordonnée 1"], df["Coordonnée 2"], lat_ref, forme, taille)
+        return pd.DataFrame({"Maille_lon": maille_lon, "Maille_lat": maille_lat}, index=df.index)
+
+    # Synthèse des mailles de chaque forêt, toutes dates confondues (dépend aussi des indices d'enjeu du référentiel,
+    # d'où la clé version_indices qui ne change qu'avec la colonne Indice_global)
+    @st.cache_data(max_entries=16)
+    def load_resume_mailles(codes_autorises, version_indices, forme, taille, partition=None, brutes=False):
+        df = preparer_observations(codes_autorises, partition, brutes)[0].join(load_mailles_observations(codes_autorises, forme, taille, partition, brutes))
+        df = df.merge(df_reference[["CD_NOM", "Indice_global"]],
+                      left_on="Code taxon (cd_nom)", right_on="CD_NOM", how="left")
+        return resumer_mailles(df)
+
+    # Classe d'enjeu et catégorie naturaliste de chaque observation (colonnes catégorielles)
+    # et masques booléens précalculés par classe et par catégorie ; chaque forêt étant une tranche contiguë
+    # du tableau des observations, le masque d'une forêt est la tranche correspondante du masque global.
+    # Clé version_enjeux : recalcul uniquement si Indice_global ou Cat_naturaliste change dans le référentiel
+    @st.cache_data(max_entries=16)
+    def load_enjeux_observations(codes_autorises, version_enjeux, partition=None, brutes=False):
+        df = preparer_observations(codes_autorises, partition, brutes)[0]
+        df_reference_cd_nom = df_reference.drop_duplicates("CD_NOM").set_index("CD_NOM")
+        codes = df["Code taxon (cd_nom)"]
+        enjeux = pd.DataFrame({
+            "Classe_enjeu": classer_enjeu(codes.map(df_reference_cd_nom["Indice_global"])).array,
+            "Cat_naturaliste": pd.Categorical(codes.map(df_reference_cd_nom["Cat_naturaliste"]), categories=sorted(df_reference_cd_nom["Cat_naturaliste"].unique())),
+        }, index=df.index)
+        masques_enjeu = {classe: (enjeux["Classe_enjeu"] == classe).to_numpy() for classe in classes_enjeu}
+        masques_categorie = {cat: (enjeux["Cat_naturaliste"] == cat).to_numpy() for cat in enjeux["Cat_naturaliste"].cat.categories}
+        return enjeux, masques_enjeu, masques_categorie
+
+    # Index inversé espèce → forêts / parcelles (construit une seule fois par jeu d'observations,
+    # ou lu depuis le stockage partitionné où il est construit lors du partitionnement)
+    @st.cache_data
+    def load_index_especes(codes_autorises, region=None, date_modification=None, brutes=False):
+        if region is not None:
+            return observations.lire_index_especes(region)
+        return observations.indexer_especes(preparer_observations(codes_autorises, brutes=brutes)[0])
+
+
+    # Stockage partitionné par région et par forêt s'il a été constitué (python observations.py --region ...),
+    # sinon fichiers uniques à la racine du dépôt
+    chemin_catalogue = observations.DOSSIER_DONNEES / "catalogue.parquet"
+    catalogue = load_catalogue(chemin_catalogue.stat().st_mtime if chemin_catalogue.exists() else None)
+    stockage_partitionne = not catalogue.empty
+    region = None
+    partition = None
+    if stockage_partitionne:
+        regions = sorted(catalogue["Région"].unique())
+        if len(regions) > 1:
+            st.sidebar.markdown("<div style='font-size:20px;'>Région :</div>", unsafe_allow_html=True)
+            region = st.sidebar.selectbox("Région", regions, key="region", label_visibility="collapsed",
+                                          on_change=lambda: st.session_state.update({"view": "start", "selected_foret": None, "selected_parcelle": None}))
+        else:
+            region = regions[0]
+        catalogue = catalogue[catalogue["Région"] == region]
+        fichier_referentiel = observations.chemin_referentiel(region)
+        dossier_versions = observations.DOSSIER_DONNEES / region / "versions"
+        # Seule la partition de la forêt consultée est chargée (aucune observation tant qu'aucune forêt n'est choisie)
+        foret_consultee = st.session_state.get("selected_foret")
+        partition = (region, foret_consultee if foret_consultee in catalogue["Forêt"].values else None)
+    else:
+        fichier_referentiel = referentiel.FICHIER_REFERENTIEL
+        dossier_versions = referentiel.DOSSIER_VERSIONS
+
+    # Observations brutes (doublons non regroupés) à la demande
+    observations_brutes = st.sidebar.toggle("Observations brutes (doublons non regroupés)", value=False, key="observations_brutes")
+
     # Exécution des fonctions de chargement
-    df = load_data()
-    codes_autorises = load_codes_autorises()
-    df_reference = load_reference_especes()
+    df_reference, version_referentiel, empreintes_especes = load_reference_especes(str(fichier_referentiel), fichier_referentiel.stat().st_mtime, str(dossier_versions))
+    codes_autorises = tuple(sorted(df_reference['CD_NOM'].unique())) # Liste des codes CD_NOM autorisés (espèces du tableau de métadonnées)
+    version_indices = referentiel.version_colonnes(df_reference, ["Indice_global"])
+    version_enjeux = referentiel.version_colonnes(df_reference, ["Indice_global", "Cat_naturaliste"])
+    df, bornes_forets = preparer_observations(codes_autorises, partition, observations_brutes)
+    index_especes = load_index_especes(codes_autorises, region, chemin_catalogue.stat().st_mtime if stockage_partitionne else None, observations_brutes)
+    enjeux_observations, masques_enjeu, masques_categorie = load_enjeux_observations(codes_autorises, version_enjeux, partition, observations_brutes)
+    df = df.join(enjeux_observations)
+    mailles_observations = load_mailles_observations(codes_autorises, FORME_MAILLE, TAILLE_MAILLE, partition, observations_brutes)
+    resume_mailles = load_resume_mailles(codes_autorises, version_indices, FORME_MAILLE, TAILLE_MAILLE, partition, observations_brutes)
     df_notice_am = load_notice_am()
     df_notice_ref = load_notice_ref()
 
-    # Nettoyage des colonnes pour garantir l'uniformité des CD_NOM
-    df_reference['CD_NOM'] = df_reference['CD_NOM'].astype(str).str.strip()
-    df["Code taxon (cd_nom)"] = df["Code taxon (cd_nom)"].astype(str).str.split(',')
-    df = df.explode("Code taxon (cd_nom)").copy() # Une ligne par taxon si plusieurs dans une même cellule
-    df["Code taxon (cd_nom)"] = df["Code taxon (cd_nom)"].str.strip()
-    df = df[df["Code taxon (cd_nom)"].isin(codes_autorises)] # Filtrage uniquement sur les espèces autorisées
-    forets = df['Forêt'].dropna().unique() # Liste des forêts sans doublons ni NaN
+    # Liste des forêts sans doublons ni NaN (catalogue global en stockage partitionné)
+    if stockage_partitionne:
+        forets = catalogue["Forêt"].to_numpy()
+        dates_extremes = (catalogue["Date_min"].min(), catalogue["Date_max"].max())
+        emprises = {ligne["Forêt"]: (ligne["lon_min"], ligne["lat_min"], ligne["lon_max"], ligne["lat_max"]) for _, ligne in catalogue.iterrows()}
+    else:
+        forets = np.array(list(bornes_forets))
+        dates_extremes = (df["Date_obs"].min(), df["Date_obs"].max())
+        emprises = None
+
+    # Filtre temporel global (carte, tableau des espèces et export)
+    periodes = {"Toutes les dates": None, "5 dernières années": 5, "10 dernières années": 10, "20 dernières années": 20, "Période personnalisée": "perso"}
+    st.sidebar.markdown("<div style='font-size:20px;'>Période d'observation :</div>", unsafe_allow_html=True)
+    choix_periode = periodes[st.sidebar.selectbox("Période d'observation", list(periodes), key="periode", label_visibility="collapsed")]
+    periode = None
+    if choix_periode == "perso":
+        periode = st.sidebar.date_input("Dates", value=(dates_extremes[0].date(), dates_extremes[1].date()), key="periode_perso", label_visibility="collapsed")
+        periode = periode if len(periode) == 2 else None
+    elif choix_periode:
+        periode = (pd.Timestamp.today().normalize() - pd.DateOffset(years=choix_periode), pd.Timestamp.today().normalize())
+
+    # Filtres par niveau d'enjeu et par catégorie naturaliste (carte, tableau des espèces et export)
+    st.sidebar.markdown("<div style='font-size:20px;'>Niveau d'enjeu minimal :</div>", unsafe_allow_html=True)
+    enjeu_minimal = st.sidebar.select_slider("Niveau d'enjeu minimal", classes_enjeu, value=classes_enjeu[0], key="enjeu_minimal", label_visibility="collapsed")
+    st.sidebar.markdown("<div style='font-size:20px;'>Catégories naturalistes :</div>", unsafe_allow_html=True)
+    categories = st.sidebar.multiselect("Catégories naturalistes", list(masques_categorie), key="categories", placeholder="Toutes", label_visibility="collapsed")
+
+    # Observations d'une forêt (tranche contiguë du tableau trié), restreintes à la période choisie
+    # puis aux niveaux d'enjeu et catégories choisis à l'aide des masques précalculés
+    def observations_foret(foret):
+        debut, fin = bornes_forets.get(foret, (0, 0))
+        df_foret = df.iloc[debut:fin]
+        if periode:
+            i, j = bornes_periode(df_foret["Date_obs"], periode)
+            debut, fin, df_foret = debut + i, debut + j, df_foret.iloc[i:j]
+        masque = None
+        if enjeu_minimal != classes_enjeu[0]:
+            masque = np.logical_or.reduce([masques_enjeu[c][debut:fin] for c in classes_enjeu[classes_enjeu.index(enjeu_minimal):]])
+        if categories:
+            masque_cat = np.logical_or.reduce([masques_categorie[c][debut:fin] for c in categories])
+            masque = masque_cat if masque is None else masque & masque_cat
+        return df_foret if masque is None else df_foret[masque]
+
+    # Démarrage unique (partagé entre les sessions) du proxy cadastre et pré-chargement éventuel des emprises des forêts
+    # (None si le port est déjà occupé, par exemple par un proxy lancé en ligne de commande : échec mémorisé)
+    @st.cache_resource
+    def demarrer_proxy_cadastre(port, precharger, _df, _emprises=None):
+        try:
+            serveur = proxy_cadastre.demarrer_proxy(port=port)
+        except OSError:
+            return None
+        if precharger:
+            emprises = list((_emprises or proxy_cadastre.emprises_forets(_df)).values())
+            threading.Thread(target=proxy_cadastre.precharger_emprises, args=(serveur.proxy, emprises), daemon=True).start()
+        return serveur
+
+    # Adresse du fond cadastre utilisée par la carte : proxy externe, proxy de l'application ou service de l'IGN
+    url_cadastre = proxy_cadastre.WMS_IGN
+    if URL_PROXY_EXTERNE:
+        url_cadastre = URL_PROXY_EXTERNE
+    elif PROXY_CADASTRE:
+        if demarrer_proxy_cadastre(PORT_PROXY_CADASTRE, PRECHARGEMENT_CADASTRE, df, emprises) is not None:
+            url_cadastre = f"http://localhost:{PORT_PROXY_CADASTRE}/"
+        else:
+            st.warning(f"Le proxy cadastre n'a pas pu démarrer (port {PORT_PROXY_CADASTRE} déjà utilisé) : le fond cadastre est chargé directement depuis l'IGN. "
+                       "Pour utiliser un proxy déjà démarré, renseignez CADASTRE_PROXY_URL.")
 
 
 
@@ -662,7 +1105,7 @@ if st.session_state.authenticated:
         # Vue forêt sélectionnée
         elif st.session_state.view == "forest_view":
             foret = st.session_state.selected_foret
-            df_foret = df[df['Forêt'] == foret]
+            df_foret = observations_foret(foret)
             
             with st.container ():
                 if st.button("📌 Filtrer par parcelle"):
@@ -673,12 +1116,12 @@ if st.session_state.authenticated:
                     st.rerun()
                 st.button("⬅️ Retour à la liste des forêts", on_click=lambda: st.session_state.update({"view": "start","selected_foret": None}))
 
-            afficher_carte(df_foret, df_reference, titre=f"📍 Carte des espèces remarquables de la forêt {foret}")
+            afficher_carte(df_foret, df_reference, titre=f"📍 Carte des espèces remarquables de la forêt {foret}", cle_selection=(foret, None, periode, enjeu_minimal, tuple(categories)))
 
         # Vue filtre par parcelle
         elif st.session_state.view == "parcelle_view":
             foret = st.session_state.selected_foret
-            df_foret = df[df['Forêt'] == foret]
+            df_foret = observations_foret(foret)
             parcelles_dispo = sorted(df_foret["Parcelle de forêt"].unique())
 
             # Définir la parcelle par défaut (si connue) OU forcer à "" sinon
@@ -699,15 +1142,15 @@ if st.session_state.authenticated:
                 if st.button("⬅️ Retour à la carte de la forêt"):
                     st.session_state.update({"view": "forest_view", "selected_parcelle": None})
 
-                afficher_carte(df_parcelle, df_reference, titre=f"📍 Espèces remarquables dans la parcelle {selected_parcelle}")
+                afficher_carte(df_parcelle, df_reference, titre=f"📍 Espèces remarquables dans la parcelle {selected_parcelle}", cle_selection=(foret, selected_parcelle, periode, enjeu_minimal, tuple(categories)))
             
         # Statuts et prescriptions forêt
         elif st.session_state.view == "species_forest":
             st.button("⬅️ Retour à la carte de la forêt", on_click=lambda: st.session_state.update({"view": "forest_view"}))
 
             st.markdown (f" ### Détails des espèces remarquables pour la forêt : {st.session_state.selected_foret}")
-            df_filtré = df[df['Forêt'] == st.session_state.selected_foret]
-            afficher_statuts_prescriptions(df_filtré, df_reference)
+            df_filtré = observations_foret(st.session_state.selected_foret)
+            afficher_statuts_prescriptions(df_filtré, df_reference, titre=f"Espèces remarquables — {st.session_state.selected_foret}")
 
         # Statuts et prescriptions parcelle
         elif st.session_state.view == "species_parcelle":
@@ -716,11 +1159,9 @@ if st.session_state.authenticated:
             st.button("⬅️ Retour à la carte de la forêt", on_click=lambda: st.session_state.update({"view": "forest_view"}))
             
             st.markdown (f" ### Détails des espèces remarquables pour la parcelle : {st.session_state.selected_parcelle}")
-            df_filtré = df[
-                (df['Forêt'] == st.session_state.selected_foret) &
-                (df['Parcelle de forêt'] == st.session_state.selected_parcelle)
-            ]
-            afficher_statuts_prescriptions(df_filtré, df_reference)
+            df_filtré = observations_foret(st.session_state.selected_foret)
+            df_filtré = df_filtré[df_filtré['Parcelle de forêt'] == st.session_state.selected_parcelle]
+            afficher_statuts_prescriptions(df_filtré, df_reference, titre=f"Espèces remarquables — {st.session_state.selected_foret} — parcelle {st.session_state.selected_parcelle}")
 
     if st.session_state.get("reset_requested"):
         st.session_state.reset_requested = False
@@ -761,7 +1202,7 @@ if st.session_state.authenticated:
                     }
                 </style>
             """, unsafe_allow_html=True)
-            match = df_reference[df_reference['CD_NOM'] == search_cd_nom]
+            match = fiche_espece(search_cd_nom, empreintes_especes.get(search_cd_nom), df_reference)
 
             # Injecter du CSS personnalisé pour modifier l'apparence des expanders
             st.markdown("""
@@ -852,13 +1293,10 @@ if st.session_state.authenticated:
                         st.write(f"**Directives européennes :** {traduire_statut(match['Directives_euro'].iloc[0])}")
                         st.write(f"**Plan d'action :** {traduire_statut(match['Plan_action'].iloc[0])}")
                         
-                        # Récupération des 3 colonnes concernées
-                        apn = match['Arrêté_protection_nationale'].iloc[0]
-                        ap_bn = match['Arrêté_protection_BN'].iloc[0]
-                        ap_hn = match['Arrêté_protection_HN'].iloc[0]
+                        # Récupération des colonnes d'arrêtés de protection (national et régionaux)
+                        valeurs_protection = [match[col].iloc[0] for col in referentiel.colonnes_protection(df_reference)]
 
                         # On filtre uniquement les valeurs différentes de "N.C."
-                        valeurs_protection = [apn, ap_bn, ap_hn]
                         valeurs_non_nc = [v for v in valeurs_protection if str(v).strip() != "N.C."]
 
                         # Affichage
@@ -877,17 +1315,36 @@ if st.session_state.authenticated:
 
             else:
                 st.info("❌ Il n'existe pas de prescription environnementale pour cette espèce.")
+
+            afficher_occurrences_espece(occurrences_espece(index_especes, search_cd_nom))
         
     
     # --------------------- PAGE REFERENTIEL ---------------------
 
     elif page == "Référentiel" :
-        st.markdown("### Tableau référentiel des statuts des espèces remarquables pour l'ONF Normandie")
+        st.markdown(f"### Tableau référentiel des statuts des espèces remarquables pour l'ONF {region or 'Normandie'}")
+
+        # Version du référentiel et différences avec la version précédente
+        versions = referentiel.lister_versions(dossier_versions)
+        date_version = next((v["date"] for v in versions if v["version"] == version_referentiel), "")
+        st.caption(f"Version du référentiel : {version_referentiel} ({date_version})")
+        precedentes = [v["version"] for v in versions if v["version"] != version_referentiel]
+        if precedentes:
+            with st.expander("🕒 Modifications depuis la version précédente"):
+                diff = referentiel.differences(referentiel.lire_version(precedentes[-1], dossier_versions), df_reference)
+                st.write(f"**Espèces ajoutées :** {', '.join(diff['ajoutes']) or 'aucune'}")
+                st.write(f"**Espèces retirées :** {', '.join(diff['retires']) or 'aucune'}")
+                for cd_nom, colonnes in diff["modifies"].items():
+                    st.write(f"**{cd_nom}** : {', '.join(colonnes)}")
+                codes_modifies = referentiel.especes_modifiees(diff)
+                forets_concernees = sorted(index_especes[index_especes.index.get_level_values(0).isin(codes_modifies)].index.get_level_values(1).unique())
+                st.write(f"**Forêts concernées (cartes et exports recalculés) :** {', '.join(forets_concernees) or 'aucune'}")
+
         # Colonnes à afficher
         colonnes_a_afficher = [
             "Cat_naturaliste", "CD_NOM", "Nom_scientifique_valide", "Nom_vernaculaire", "LR_nat", "LR_reg", 
             "Vulnérabilité", "Respo_reg", "Conservation", "Réglementaire", "Indice_global", 
-            "Directives_euro", "Plan_action", "Arrêté_protection_nationale", "Arrêté_protection_BN", "Arrêté_protection_HN", "Article_arrêté",
+            "Directives_euro", "Plan_action", *referentiel.colonnes_protection(df_reference), "Article_arrêté",
             "Type_protection", "LC_non_traçable"
         ]
 
@@ -907,7 +1364,7 @@ if st.session_state.authenticated:
         styled_df = styled_df.apply(color_by_cat, axis=None)
 
         # Mise en forme conditionnelle sur indice_global
-        styled_df = styled_df.applymap(color_indice, subset=['Indice_global'])
+        styled_df = styled_df.map(color_indice, subset=['Indice_global'])
 
         # ➤ Styles pour l’en-tête
         styles_entetes = [
@@ -933,16 +1390,11 @@ if st.session_state.authenticated:
         #Afficher
         st.write(styled_df)
         
-        # ➤ Export Excel avec mise en forme
-        output = BytesIO()
-        styled_df.to_excel(output, engine='openpyxl', index=False)
-        output.seek(0)
-
-        st.download_button(
-            label="📥 Télécharger le référentiel (.xlsx)",
-            data=output,
-            file_name="referentiel_especes.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        # ➤ Export Excel avec mise en forme (en arrière-plan, une fois par version du référentiel)
+        bouton_export(
+            ("referentiel", version_referentiel), "📥 Télécharger le référentiel (.xlsx)",
+            "referentiel_especes.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            "download_referentiel", ecrire_referentiel_xlsx, styled_df
         )
 
         buffer = io.BytesIO()
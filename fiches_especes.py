@@ -0,0 +1,201 @@
+# --------------------- IMPORTS ---------------------
+
+import argparse # options de la ligne de commande
+import html
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor # rendu parallèle des fiches (ligne de commande)
+from pathlib import Path
+
+import pandas as pd
+
+import observations # ingestion des observations
+import referentiel # lecture et version du référentiel
+from referentiel import traduire_statut, classer_enjeu, classe_enjeu, couleurs_enjeu, get_indice_global_color
+
+# --------------------- CONFIGURATION ---------------------
+
+# Dossier du cache des fiches : une fiche par espèce et par empreinte de l'espèce dans le référentiel
+DOSSIER_FICHES = Path(__file__).parent / ".fiches_especes"
+
+# Mise en page des documents imprimables (une fiche par page)
+STYLE_IMPRESSION = """
+    body { font-family: sans-serif; font-size: 12pt; color: #1B1B1B; margin: 1.5cm; }
+    h1 { color: #2E7D32; }
+    section.fiche { page-break-after: always; break-after: page; }
+    section.fiche:last-child { page-break-after: auto; break-after: auto; }
+    .indice { display: inline-block; padding: 4px 10px; border-radius: 8px; font-size: 14pt; }
+    .encadre { background-color: #DDEEDD; padding: 8px 12px; border-radius: 6px; margin: 8px 0; }
+    dt { font-weight: bold; margin-top: 6px; }
+    dd { margin-left: 0; }
+"""
+
+respo_dict = {1: "Faible", 2: "Modérée", 3: "Significative", 4: "Forte", 5: "Majeure"}
+
+# --------------------- FONCTIONS ---------------------
+
+# Fonction d'échappement d'une valeur du référentiel pour l'HTML (liens cliquables, retours à la ligne conservés)
+def texte_html(val):
+    if val is None or (not isinstance(val, str) and pd.isna(val)):
+        return ""
+    texte = html.escape(str(val))
+    texte = re.sub(r"(https?://[^\s<]+)", r'<a href="\1">\1</a>', texte)
+    return texte.replace("\n", "<br>")
+
+
+# Fonction de rendu de la fiche "Statuts et prescriptions" d'une espèce (fragment HTML) ;
+# la classe et la couleur d'enjeu sont lues dans Classe_enjeu / Couleur_enjeu si elles ont été précalculées
+def rendre_fiche(ligne):
+    e = {cle: texte_html(val) for cle, val in ligne.items()}
+    titre = f"<h2>📘 Statuts et prescriptions : {e['Nom_vernaculaire'] or e['CD_NOM']}</h2>"
+    if not str(ligne.get("Rôle_TFT", "")).strip() or str(ligne.get("Rôle_TFT", "")).strip().upper() == "N.C.":
+        return f"""<section class="fiche">{titre}
+        <p><b>CD_NOM :</b> {e['CD_NOM']} — <i>{e['Nom_scientifique_valide']}</i></p>
+        <p>❌ Cette espèce ne fait pas l'objet de prescription environnementale.</p></section>"""
+
+    protections = [val for col, val in ligne.items() if col.startswith("Arrêté_protection_")]
+    protections = [texte_html(v) for v in protections if str(v).strip() not in ("N.C.", "")]
+    classe = ligne["Classe_enjeu"] if "Classe_enjeu" in ligne else classe_enjeu(ligne.get("Indice_global"))
+    couleur = ligne["Couleur_enjeu"] if "Couleur_enjeu" in ligne else get_indice_global_color(ligne.get("Indice_global"))
+
+    return f"""<section class="fiche">{titre}
+    <p><b>CD_NOM :</b> {e['CD_NOM']}<br>
+    <b>Nom scientifique :</b> {e['Nom_scientifique_valide']}<br>
+    <b>Nom vernaculaire :</b> {e['Nom_vernaculaire']}<br>
+    <b>Catégorie naturaliste :</b> {e['Cat_naturaliste']}</p>
+    <div class="indice" style="background-color: {couleur};">
+        <b>Indice d'enjeu global :</b> {e['Indice_global']} / 20 {'(' + classe + ')' if pd.notna(classe) else ''}</div>
+    <hr>
+    <p><b>Code unique clause :</b> {e['Code_unique']}<br>
+    <b>Condition d'application de la clause :</b> {e['Condition(s)_application_clause']}<br>
+    <b>Rôle du TFT :</b> {e['Rôle_TFT']}</p>
+    <div class="encadre"><b>📋 Libellé des clauses à inscrire</b>
+    <dl>
+        <dt>Fiche chantier (TECK)</dt><dd>{e['Libellé_fiche_chantier_ONF (TECK)']}</dd>
+        <dt>Fiche désignation (DESIGNATION MOBILE)</dt><dd>{e['Libellé_fiche_désignation_ONF (DESIGNATION MOBILE)']}</dd>
+        <dt>Fiche vente (PRODUCTION BOIS)</dt><dd>{e['Libellé_fiche_vente_ONF (PRODUCTION BOIS)']}</dd>
+    </dl></div>
+    <div class="encadre"><b>📘 Détail des statuts</b><br>
+    <b>Indice de priorité réglementaire :</b> {e['Réglementaire']} / 4<br>
+    <b>Indice de priorité de conservation :</b> {e['Conservation']} / 4<br>
+    <b>Liste rouge régionale :</b> {texte_html(traduire_statut(ligne.get('LR_reg')))}<br>
+    <b>Liste rouge nationale :</b> {texte_html(traduire_statut(ligne.get('LR_nat')))}<br>
+    <b>Responsabilité régionale :</b> {respo_dict.get(ligne.get('Respo_reg'), "Non Renseigné")}<br>
+    <b>Directives européennes :</b> {texte_html(traduire_statut(ligne.get('Directives_euro')))}<br>
+    <b>Plan d'action :</b> {texte_html(traduire_statut(ligne.get('Plan_action')))}<br>
+    <b>Arrêté de protection :</b> {', '.join(protections) if protections else 'Non Concerné'}<br>
+    <b>Article de l'arrêté :</b> {texte_html(traduire_statut(ligne.get('Article_arrêté')))}</div>
+    {'<div class="encadre"><b>➕ Pour aller plus loin</b><br>' + e['Conseils_gestion'] + '</div>' if e.get('Conseils_gestion') else ''}
+    </section>"""
+
+
+def _rendre_et_enregistrer(tache):
+    chemin, ligne = tache
+    contenu = rendre_fiche(ligne)
+    temporaire = Path(f"{chemin}.tmp")
+    temporaire.write_text(contenu, encoding="utf-8")
+    temporaire.replace(chemin)
+    return contenu
+
+
+# Fonction de génération des fiches d'une liste d'espèces : seules les fiches absentes du cache pour l'empreinte
+# actuelle de l'espèce sont rendues, dans le processus courant (l'application les génère depuis un thread d'export).
+# nb_processus > 1 répartit le rendu sur des processus démarrés en "spawn" (ligne de commande).
+# avancer(fraction, message) est appelée après chaque fiche rendue
+def generer_fiches(df_reference, codes, dossier=DOSSIER_FICHES, nb_processus=None, avancer=None):
+    dossier = Path(dossier)
+    dossier.mkdir(parents=True, exist_ok=True)
+    df_reference = df_reference.drop_duplicates("CD_NOM").set_index("CD_NOM", drop=False)
+    empreintes = referentiel.empreintes_especes(df_reference)
+    codes = [c for c in dict.fromkeys(str(c) for c in codes) if c in df_reference.index]
+
+    chemins = {c: dossier / f"{c}-{empreintes[c]}.html" for c in codes}
+    a_rendre = [c for c in codes if not chemins[c].exists()]
+
+    # Classes et couleurs d'enjeu calculées une fois pour toutes les fiches à rendre
+    lignes = df_reference.loc[a_rendre].copy()
+    classes = classer_enjeu(lignes["Indice_global"].to_numpy()).astype(object)
+    lignes["Classe_enjeu"] = classes.to_numpy()
+    lignes["Couleur_enjeu"] = classes.map(couleurs_enjeu).fillna("#ffffff").to_numpy()
+    taches = [(chemins[c], ligne) for c, ligne in zip(a_rendre, lignes.to_dict("records"))]
+
+    if nb_processus and nb_processus > 1 and taches:
+        executeur = ProcessPoolExecutor(max_workers=nb_processus, mp_context=multiprocessing.get_context("spawn"))
+        with executeur:
+            rendues = executeur.map(_rendre_et_enregistrer, taches, chunksize=16)
+            for i, _ in enumerate(rendues, 1):
+                if avancer:
+                    avancer(i / len(taches), f"{i}/{len(taches)} fiche(s) rendue(s)")
+    else:
+        for i, tache in enumerate(taches, 1):
+            _rendre_et_enregistrer(tache)
+            if avancer:
+                avancer(i / len(taches), f"{i}/{len(taches)} fiche(s) rendue(s)")
+
+    # Suppression des fiches des versions précédentes des espèces re-rendues
+    for c in a_rendre:
+        for ancienne in dossier.glob(f"{c}-*.html"):
+            if ancienne != chemins[c]:
+                ancienne.unlink(missing_ok=True)
+
+    return {c: chemins[c].read_text(encoding="utf-8") for c in codes}
+
+
+# Fonction d'assemblage d'un document HTML imprimable à partir de fiches
+def document_html(titre, fiches):
+    return f"""<!DOCTYPE html>
+<html lang="fr"><head><meta charset="utf-8"><title>{html.escape(titre)}</title>
+<style>{STYLE_IMPRESSION}</style></head>
+<body><h1>{html.escape(titre)}</h1>
+{''.join(fiches)}
+</body></html>"""
+
+
+# Fonction de génération du document regroupant les fiches des espèces d'une sélection,
+# classées par indice d'enjeu global décroissant puis par nom
+def generer_document(df_reference, codes, titre, avancer=None, nb_processus=None):
+    fiches = generer_fiches(df_reference, codes, avancer=avancer, nb_processus=nb_processus)
+    ordre = df_reference[df_reference["CD_NOM"].isin(list(fiches))].assign(
+        Indice=lambda d: pd.to_numeric(d["Indice_global"], errors="coerce")
+    ).sort_values(["Indice", "Nom_vernaculaire"], ascending=[False, True])["CD_NOM"]
+    return document_html(titre, [fiches[c] for c in dict.fromkeys(ordre)])
+
+
+# --------------------- LIGNE DE COMMANDE ---------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Génération des fiches imprimables des statuts et prescriptions des espèces")
+    parser.add_argument("--foret", help="Forêt (par défaut : toutes les espèces du référentiel)")
+    parser.add_argument("--parcelle", help="Parcelle de la forêt")
+    parser.add_argument("--par-espece", action="store_true", help="Un fichier par espèce au lieu d'un document unique")
+    parser.add_argument("--sortie", default="fiches", help="Dossier de sortie")
+    parser.add_argument("--region", help="Région du stockage partitionné (par défaut : fichiers à la racine du dépôt)")
+    parser.add_argument("--processus", type=int, default=1, help="Nombre de processus de rendu")
+    args = parser.parse_args()
+
+    if args.region:
+        df_reference = referentiel.lire_referentiel(observations.chemin_referentiel(args.region))
+    else:
+        df_reference = referentiel.lire_referentiel()
+    if args.foret:
+        df_observations = observations.lire_partition(args.region, args.foret) if args.region else observations.lire_observations()
+        df, _ = observations.preparer(df_observations, df_reference["CD_NOM"].tolist())
+        df = df[df["Forêt"] == args.foret]
+        if args.parcelle:
+            df = df[df["Parcelle de forêt"].astype(str) == args.parcelle]
+        codes = df["Code taxon (cd_nom)"].unique().tolist()
+        titre = f"Espèces remarquables — {args.foret}" + (f" — parcelle {args.parcelle}" if args.parcelle else "")
+    else:
+        codes = df_reference["CD_NOM"].tolist()
+        titre = "Espèces remarquables — référentiel complet"
+
+    sortie = Path(args.sortie)
+    sortie.mkdir(parents=True, exist_ok=True)
+    if args.par_espece:
+        for cd_nom, fiche in generer_fiches(df_reference, codes, nb_processus=args.processus).items():
+            (sortie / f"fiche_{cd_nom}.html").write_text(document_html(f"Fiche espèce {cd_nom}", [fiche]), encoding="utf-8")
+        print(f"{len(codes)} fiche(s) écrite(s) dans {sortie}")
+    else:
+        chemin = sortie / "fiches_especes.html"
+        chemin.write_text(generer_document(df_reference, codes, titre, nb_processus=args.processus), encoding="utf-8")
+        print(f"Document écrit : {chemin}")
@@ -0,0 +1,232 @@
+# --------------------- IMPORTS ---------------------
+
+import argparse # options de la ligne de commande
+import hashlib # nom des fichiers de partition
+import re
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# --------------------- CONFIGURATION ---------------------
+
+# Export de la Base de données naturalistes de l'ONF
+FICHIER_OBSERVATIONS = Path(__file__).parent / "MonExportBdn.xlsx"
+
+# Stockage partitionné par région et par forêt (un fichier parquet par forêt) et catalogue global des forêts :
+#   donnees/catalogue.parquet
+#   donnees/<région>/Metadonnees.xlsx, index_especes.parquet, schema.parquet
+#   donnees/<région>/forets/<forêt>.parquet
+DOSSIER_DONNEES = Path(__file__).parent / "donnees"
+
+# Regroupement des doublons : nombre de décimales des coordonnées (5 décimales ≈ 1 m) et colonnes texte fusionnées
+DECIMALES_DOUBLONS = 5
+COLONNES_FUSIONNEES = ["Observateur(s)", "Commentaire du relevé", "Commentaire de la localisation", "Commentaire de l'observation"]
+
+# --------------------- FONCTIONS ---------------------
+
+# Fonction de lecture de l'export de la Base de données naturalistes
+def lire_observations(chemin=FICHIER_OBSERVATIONS):
+    return pd.read_excel(chemin)
+
+
+# Fonction de regroupement des doublons : les observations d'un même taxon, à la même position (coordonnées arrondies),
+# à la même date et dans la même parcelle sont fusionnées en une seule (hachage vectorisé de ces colonnes).
+# Les observateurs et commentaires distincts sont conservés et Nb_doublons compte les observations fusionnées en plus de la première
+def consolider(df, decimales=DECIMALES_DOUBLONS):
+    poids = df["Nb_doublons"].to_numpy() + 1 if "Nb_doublons" in df.columns else 1
+    df = df.assign(Nb_doublons=poids)
+    cles = pd.DataFrame({
+        "cd_nom": df["Code taxon (cd_nom)"].astype(str).to_numpy(),
+        "foret": df["Forêt"].astype(str).to_numpy(),
+        "parcelle": df["Parcelle de forêt"].astype(str).to_numpy(),
+        "date": df["Date_obs"].to_numpy(),
+        "lon": df["Coordonnée 1"].round(decimales).to_numpy(),
+        "lat": df["Coordonnée 2"].round(decimales).to_numpy(),
+    })
+    hachages = pd.util.hash_pandas_object(cles, index=False).to_numpy()
+    doublons = pd.Series(hachages).duplicated(keep=False).to_numpy()
+
+    # Seules les lignes en double sont regroupées, les autres sont conservées telles quelles
+    uniques = df[~doublons]
+    groupes = df[doublons].assign(_cle=hachages[doublons])
+    regles = {col: "first" for col in groupes.columns if col not in ("_cle", "Nb_doublons", *COLONNES_FUSIONNEES)}
+    regles["Nb_doublons"] = "sum"
+    fusion = groupes.groupby("_cle", sort=False).agg(regles)
+
+    # Valeurs texte distinctes de chaque groupe (les observateurs multiples d'une cellule sont séparés au préalable)
+    for col in COLONNES_FUSIONNEES:
+        if col not in groupes.columns:
+            continue
+        valeurs = groupes[["_cle", col]].dropna()
+        valeurs[col] = valeurs[col].astype(str).str.strip()
+        if col == "Observateur(s)":
+            valeurs[col] = valeurs[col].str.split(r"\s*,\s*")
+            valeurs = valeurs.explode(col)
+        valeurs = valeurs[valeurs[col] != ""].drop_duplicates()
+        separateur = ", " if col == "Observateur(s)" else "\n"
+        fusion[col] = valeurs.groupby("_cle", sort=False)[col].agg(separateur.join).reindex(fusion.index)
+
+    df = pd.concat([uniques, fusion.reset_index(drop=True)[uniques.columns]], ignore_index=True)
+    df["Nb_doublons"] = (df["Nb_doublons"] - 1).astype("int32")
+    return df
+
+
+# Fonction de préparation des observations à l'ingestion : une ligne par taxon, filtrage sur les espèces autorisées,
+# regroupement des doublons (sauf si consolidation=False), tri par forêt puis par date ;
+# retourne le tableau et les bornes (début, fin) de chaque forêt dans le tableau trié
+def preparer(df, codes_autorises, consolidation=True):
+    # Nettoyage des colonnes pour garantir l'uniformité des CD_NOM
+    df["Code taxon (cd_nom)"] = df["Code taxon (cd_nom)"].astype(str).str.split(',')
+    df = df.explode("Code taxon (cd_nom)").copy() # Une ligne par taxon si plusieurs dans une même cellule
+    df["Code taxon (cd_nom)"] = df["Code taxon (cd_nom)"].str.strip()
+    df = df[df["Code taxon (cd_nom)"].isin(codes_autorises)] # Filtrage uniquement sur les espèces autorisées
+
+    # Index temporel : tri par forêt puis par date d'observation (dates manquantes en fin de forêt)
+    df["Date_obs"] = pd.to_datetime(df["Date début"], errors="coerce", dayfirst=True)
+    if consolidation:
+        df = consolider(df)
+    elif "Nb_doublons" not in df.columns:
+        df["Nb_doublons"] = np.zeros(len(df), dtype="int32")
+    df = df.sort_values(["Forêt", "Date_obs"], kind="stable", na_position="last").reset_index(drop=True)
+
+    # Bornes (début, fin) de chaque forêt dans le tableau trié
+    groupes = df.groupby("Forêt", sort=False).indices
+    bornes_forets = {foret: (int(pos[0]), int(pos[-1]) + 1) for foret, pos in groupes.items()}
+    return df, bornes_forets
+
+
+# Construction de l'index inversé espèce → forêts / parcelles à l'ingestion :
+# une ligne par (CD_NOM, forêt, parcelle) avec le nombre d'observations, la date de la dernière observation
+# et la position moyenne, triée par CD_NOM pour une recherche directe (forêts et parcelles stockées en catégories)
+def indexer_especes(df):
+    occurrences = df.loc[df["Forêt"].notna(), ["Code taxon (cd_nom)", "Forêt", "Parcelle de forêt", "Date_obs", "Coordonnée 1", "Coordonnée 2"]].copy()
+    occurrences["Parcelle de forêt"] = occurrences["Parcelle de forêt"].map(lambda p: "Non renseignée" if pd.isna(p) else str(p))
+    occurrences = occurrences.astype({"Code taxon (cd_nom)": "category", "Forêt": "category", "Parcelle de forêt": "category"})
+    index = occurrences.groupby(["Code taxon (cd_nom)", "Forêt", "Parcelle de forêt"], observed=True).agg(
+        Nb_observations=("Date_obs", "size"),
+        Derniere_observation=("Date_obs", "max"),
+        Longitude=("Coordonnée 1", "mean"),
+        Latitude=("Coordonnée 2", "mean"),
+    )
+    index["Nb_observations"] = index["Nb_observations"].astype("int32")
+    return index.sort_index()
+
+
+# Fonction de conversion d'un nom de forêt en nom de fichier (un court hachage du nom exact évite que deux forêts
+# dont les noms ne diffèrent que par la ponctuation, comme "FD X (1)" et "FD X [1]", partagent le même fichier)
+def nom_partition(foret):
+    empreinte = hashlib.sha1(str(foret).encode("utf-8")).hexdigest()[:8]
+    return re.sub(r"[^0-9A-Za-z_-]+", "_", str(foret)).strip("_") + f"-{empreinte}.parquet"
+
+
+# Fonction de construction du chemin du référentiel d'une région du stockage partitionné
+def chemin_referentiel(region, dossier=DOSSIER_DONNEES):
+    return Path(dossier) / region / "Metadonnees.xlsx"
+
+
+# Fonction d'homogénéisation des colonnes texte avant écriture en parquet (colonnes mixtes texte/nombre/date)
+def _colonnes_texte(df):
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].map(lambda v: None if pd.isna(v) else str(v)).astype(object)
+    return df
+
+
+# Fonction de restauration des numéros de parcelle lus depuis une partition : les parcelles sont écrites en texte
+# (la colonne mêle nombres et texte dans l'export BDN), les numéros entiers redeviennent des nombres comme dans l'export
+def _restaurer_parcelles(df):
+    df["Parcelle de forêt"] = df["Parcelle de forêt"].map(
+        lambda p: int(p) if isinstance(p, str) and p.isdigit() else p
+    ).astype(object)
+    return df
+
+
+# Fonction de lecture du catalogue des forêts (vide si le stockage partitionné n'existe pas)
+def lire_catalogue(dossier=DOSSIER_DONNEES):
+    chemin = Path(dossier) / "catalogue.parquet"
+    if not chemin.exists():
+        return pd.DataFrame(columns=["Région", "Agence", "Forêt", "Fichier", "Nb_observations", "lon_min", "lat_min", "lon_max", "lat_max", "Date_min", "Date_max"])
+    return pd.read_parquet(chemin)
+
+
+# Fonction de lecture d'une partition (observations d'une forêt) ; sans forêt, retourne un tableau vide avec les bonnes colonnes
+def lire_partition(region, foret=None, dossier=DOSSIER_DONNEES):
+    dossier_region = Path(dossier) / region
+    if foret is None:
+        return _restaurer_parcelles(pd.read_parquet(dossier_region / "schema.parquet"))
+    return _restaurer_parcelles(pd.read_parquet(dossier_region / "forets" / nom_partition(foret)))
+
+
+# Fonction de lecture de toutes les partitions d'une région (services et lignes de commande qui couvrent toutes les forêts)
+def lire_region(region, dossier=DOSSIER_DONNEES):
+    catalogue = lire_catalogue(dossier)
+    forets = catalogue.loc[catalogue["Région"] == region, "Forêt"]
+    if forets.empty:
+        raise ValueError(f"Région absente du stockage partitionné : {region}")
+    return pd.concat([lire_partition(region, foret, dossier) for foret in forets], ignore_index=True)
+
+
+# Fonction de lecture de l'index inversé espèce → forêts / parcelles d'une région
+def lire_index_especes(region, dossier=DOSSIER_DONNEES):
+    index = pd.read_parquet(Path(dossier) / region / "index_especes.parquet")
+    return index.set_index(["Code taxon (cd_nom)", "Forêt", "Parcelle de forêt"]).sort_index()
+
+
+# Fonction d'écriture des partitions d'une région : observations préparées par forêt, schéma, index inversé,
+# copie du référentiel de la région, puis mise à jour du catalogue global (les lignes de la région sont remplacées)
+def partitionner(df, region, agence="", fichier_referentiel=None, dossier=DOSSIER_DONNEES):
+    dossier = Path(dossier)
+    dossier_forets = dossier / region / "forets"
+    if dossier_forets.exists():
+        shutil.rmtree(dossier_forets)
+    dossier_forets.mkdir(parents=True)
+
+    df = df[df["Forêt"].notna()]
+    _colonnes_texte(df.iloc[0:0]).to_parquet(dossier / region / "schema.parquet", index=False)
+    lignes = []
+    fichiers = df["Forêt"].drop_duplicates().map(nom_partition)
+    if fichiers.duplicated().any():
+        raise ValueError(f"Plusieurs forêts partagent le même fichier de partition : {', '.join(fichiers[fichiers.duplicated()])}")
+    for foret, df_foret in df.groupby("Forêt", sort=True):
+        _colonnes_texte(df_foret).to_parquet(dossier_forets / nom_partition(foret), index=False)
+        lignes.append({
+            "Région": region, "Agence": agence, "Forêt": foret, "Fichier": nom_partition(foret),
+            "Nb_observations": len(df_foret),
+            "lon_min": df_foret["Coordonnée 1"].min(), "lat_min": df_foret["Coordonnée 2"].min(),
+            "lon_max": df_foret["Coordonnée 1"].max(), "lat_max": df_foret["Coordonnée 2"].max(),
+            "Date_min": df_foret["Date_obs"].min(), "Date_max": df_foret["Date_obs"].max(),
+        })
+
+    # Index construit sur les observations telles qu'elles sont relues (parcelles restaurées comme dans lire_partition)
+    index = indexer_especes(consolider(_restaurer_parcelles(_colonnes_texte(df)))).reset_index()
+    index.to_parquet(dossier / region / "index_especes.parquet", index=False)
+    if fichier_referentiel is not None:
+        shutil.copy2(fichier_referentiel, chemin_referentiel(region, dossier))
+
+    catalogue = lire_catalogue(dossier)
+    catalogue = pd.concat([catalogue[catalogue["Région"] != region], pd.DataFrame(lignes)], ignore_index=True)
+    catalogue.to_parquet(dossier / "catalogue.parquet", index=False)
+    return catalogue
+
+
+# --------------------- LIGNE DE COMMANDE ---------------------
+
+if __name__ == "__main__":
+    import referentiel
+
+    parser = argparse.ArgumentParser(description="Partitionnement des observations d'une région par forêt")
+    parser.add_argument("--region", required=True, help="Nom de la région (ex. Normandie)")
+    parser.add_argument("--agence", default="", help="Agence territoriale")
+    parser.add_argument("--observations", default=str(FICHIER_OBSERVATIONS), help="Export de la BDN (.xlsx)")
+    parser.add_argument("--referentiel", default=str(referentiel.FICHIER_REFERENTIEL), help="Référentiel des espèces de la région (.xlsx)")
+    parser.add_argument("--dossier", default=str(DOSSIER_DONNEES), help="Dossier du stockage partitionné")
+    args = parser.parse_args()
+
+    df_reference = referentiel.lire_referentiel(args.referentiel)
+    # Les partitions conservent les observations brutes (le regroupement des doublons est fait au chargement)
+    df, _ = preparer(lire_observations(args.observations), df_reference["CD_NOM"].tolist(), consolidation=False)
+    catalogue = partitionner(df, args.region, args.agence, args.referentiel, args.dossier)
+    print(f"{(catalogue['Région'] == args.region).sum()} forêt(s) écrite(s) pour la région {args.region} dans {args.dossier}")
@@ -0,0 +1,286 @@
+# --------------------- IMPORTS ---------------------
+
+import argparse # options de la ligne de commande
+import hashlib # clé de cache des tuiles
+import math # calcul des emprises de tuiles
+import os
+import threading # serveur et pré-chargement en arrière-plan
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor # pré-chargement parallèle
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# --------------------- CONFIGURATION ---------------------
+
+# Service WMS de l'IGN interrogé par défaut (couche cadastre)
+WMS_IGN = "https://data.geopf.fr/wms-r/wms"
+COUCHE_CADASTRE = "CADASTRALPARCELS.PARCELLAIRE_EXPRESS"
+
+# Paramètres par défaut du cache disque
+DOSSIER_CACHE = Path(__file__).parent / ".cache_cadastre"
+TAILLE_MAX_CACHE = 500 * 1024 * 1024 # 500 Mo
+AGE_MAX_CACHE = 30 * 24 * 3600 # 30 jours (le cadastre est mis à jour peu souvent)
+
+# Paramètres du pré-chargement (tuiles 256 px en Web Mercator, comme Leaflet)
+ZOOMS_PRECHARGEMENT = (13, 14, 15)
+TAILLE_TUILE = 256
+ORIGINE_MERCATOR = 20037508.342789244
+
+# --------------------- FONCTIONS ---------------------
+
+# Fonction de normalisation d'une requête WMS pour en faire une clé de cache stable
+# (noms de paramètres en minuscules, ordre indifférent, bbox arrondie au centimètre
+# pour que les requêtes du navigateur et celles du pré-chargement coïncident)
+def cle_requete(params):
+    normalises = {}
+    for cle, valeur in params.items():
+        cle = cle.lower()
+        if cle == "bbox":
+            try:
+                valeur = ",".join(f"{float(v):.2f}" for v in valeur.split(","))
+            except ValueError:
+                pass
+        normalises[cle] = valeur
+    texte = "&".join(f"{k}={normalises[k]}" for k in sorted(normalises))
+    return hashlib.sha1(texte.encode("utf-8")).hexdigest()
+
+
+# Cache disque des réponses WMS avec éviction par âge et par taille totale
+class CacheTuiles:
+    def __init__(self, dossier=DOSSIER_CACHE, taille_max=TAILLE_MAX_CACHE, age_max=AGE_MAX_CACHE):
+        self.dossier = Path(dossier)
+        self.dossier.mkdir(parents=True, exist_ok=True)
+        self.taille_max = taille_max
+        self.age_max = age_max
+        self._verrou = threading.Lock()
+        self._taille = sum(f.stat().st_size for f in self.dossier.glob("*.tuile"))
+
+    def _chemin(self, cle):
+        return self.dossier / f"{cle}.tuile"
+
+    # Lecture d'une tuile : None si absente ou trop ancienne
+    def lire(self, cle):
+        chemin = self._chemin(cle)
+        try:
+            stat = chemin.stat()
+        except FileNotFoundError:
+            return None
+        if time.time() - stat.st_mtime > self.age_max:
+            self._supprimer(chemin)
+            return None
+        with open(chemin, "rb") as f:
+            contenu = f.read()
+        # On met à jour la date d'accès pour que l'éviction supprime d'abord les tuiles les moins consultées
+        os.utime(chemin, (time.time(), stat.st_mtime))
+        type_mime, _, donnees = contenu.partition(b"\n")
+        return type_mime.decode("ascii"), donnees
+
+    # Écriture atomique d'une tuile puis éviction si la taille maximale est dépassée
+    def ecrire(self, cle, type_mime, donnees):
+        chemin = self._chemin(cle)
+        temporaire = chemin.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(temporaire, "wb") as f:
+            f.write(type_mime.encode("ascii") + b"\n" + donnees)
+        with self._verrou:
+            ancien = chemin.stat().st_size if chemin.exists() else 0
+            os.replace(temporaire, chemin)
+            self._taille += chemin.stat().st_size - ancien
+        if self._taille > self.taille_max:
+            self.evincer()
+
+    def contient(self, cle):
+        chemin = self._chemin(cle)
+        return chemin.exists() and time.time() - chemin.stat().st_mtime <= self.age_max
+
+    def _supprimer(self, chemin):
+        with self._verrou:
+            try:
+                taille = chemin.stat().st_size
+                chemin.unlink()
+                self._taille -= taille
+            except FileNotFoundError:
+                pass
+
+    # Suppression des tuiles expirées puis des moins récemment consultées jusqu'à 90 % de la taille maximale
+    def evincer(self):
+        maintenant = time.time()
+        fichiers = []
+        for chemin in self.dossier.glob("*.tuile"):
+            try:
+                stat = chemin.stat()
+            except FileNotFoundError:
+                continue
+            if maintenant - stat.st_mtime > self.age_max:
+                self._supprimer(chemin)
+            else:
+                fichiers.append((stat.st_atime, chemin))
+        fichiers.sort()
+        cible = int(self.taille_max * 0.9)
+        for _, chemin in fichiers:
+            if self._taille <= cible:
+                break
+            self._supprimer(chemin)
+
+
+# Proxy WMS : sert les tuiles depuis le cache et interroge le service amont en cas d'absence
+class ProxyWMS:
+    def __init__(self, url_amont=WMS_IGN, cache=None, delai=20):
+        self.url_amont = url_amont
+        self.cache = cache if cache is not None else CacheTuiles()
+        self.delai = delai
+
+    def obtenir(self, params):
+        cle = cle_requete(params)
+        tuile = self.cache.lire(cle)
+        if tuile is not None:
+            return tuile[0], tuile[1], True
+        url = f"{self.url_amont}?{urllib.parse.urlencode(params)}"
+        with urllib.request.urlopen(url, timeout=self.delai) as reponse:
+            type_mime = reponse.headers.get_content_type()
+            donnees = reponse.read()
+        # Les erreurs WMS (ServiceException en XML) ne sont pas mises en cache
+        if type_mime.startswith("image/"):
+            self.cache.ecrire(cle, type_mime, donnees)
+        return type_mime, donnees, False
+
+
+def _gestionnaire(proxy):
+    class Gestionnaire(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+            try:
+                type_mime, donnees, en_cache = proxy.obtenir(params)
+            except (urllib.error.URLError, TimeoutError) as e:
+                self.send_error(502, f"Service WMS injoignable : {e}")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", type_mime)
+            self.send_header("Content-Length", str(len(donnees)))
+            self.send_header("Cache-Control", "public, max-age=86400")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("X-Cache", "HIT" if en_cache else "MISS")
+            self.end_headers()
+            self.wfile.write(donnees)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Gestionnaire
+
+
+# Fonction de démarrage du proxy dans un thread (retourne le serveur pour pouvoir l'arrêter)
+def demarrer_proxy(hote="127.0.0.1", port=8765, proxy=None):
+    proxy = proxy if proxy is not None else ProxyWMS()
+    serveur = ThreadingHTTPServer((hote, port), _gestionnaire(proxy))
+    serveur.daemon_threads = True
+    serveur.proxy = proxy
+    threading.Thread(target=serveur.serve_forever, daemon=True).start()
+    return serveur
+
+
+# Fonction de conversion d'une longitude / latitude (WGS84) en coordonnées Web Mercator
+def lonlat_vers_mercator(lon, lat):
+    x = lon * ORIGINE_MERCATOR / 180
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    y = math.log(math.tan((90 + lat) * math.pi / 360)) * 6378137
+    return x, y
+
+
+# Fonction listant les emprises (EPSG:3857) des tuiles couvrant une emprise WGS84 pour un niveau de zoom
+def emprises_tuiles(lon_min, lat_min, lon_max, lat_max, zoom):
+    cote = 2 * ORIGINE_MERCATOR / 2 ** zoom
+    x_min, y_min = lonlat_vers_mercator(lon_min, lat_min)
+    x_max, y_max = lonlat_vers_mercator(lon_max, lat_max)
+    col_min = int((x_min + ORIGINE_MERCATOR) // cote)
+    col_max = int((x_max + ORIGINE_MERCATOR) // cote)
+    lig_min = int((ORIGINE_MERCATOR - y_max) // cote)
+    lig_max = int((ORIGINE_MERCATOR - y_min) // cote)
+    for col in range(col_min, col_max + 1):
+        for lig in range(lig_min, lig_max + 1):
+            gauche = col * cote - ORIGINE_MERCATOR
+            haut = ORIGINE_MERCATOR - lig * cote
+            yield gauche, haut - cote, gauche + cote, haut
+
+
+# Paramètres de la requête GetMap envoyée par Leaflet pour la couche cadastre de l'application
+def params_getmap(emprise, couche=COUCHE_CADASTRE):
+    return {
+        "service": "WMS",
+        "request": "GetMap",
+        "layers": couche,
+        "styles": "",
+        "format": "image/png",
+        "transparent": "true",
+        "version": "1.3.0",
+        "width": str(TAILLE_TUILE),
+        "height": str(TAILLE_TUILE),
+        "crs": "EPSG:3857",
+        "bbox": ",".join(repr(v) for v in emprise),
+    }
+
+
+# Fonction de pré-chargement des tuiles couvrant une liste d'emprises WGS84 (lon_min, lat_min, lon_max, lat_max)
+def precharger_emprises(proxy, emprises, zooms=ZOOMS_PRECHARGEMENT, nb_threads=4):
+    requetes = [
+        params_getmap(emprise)
+        for lon_min, lat_min, lon_max, lat_max in emprises
+        for zoom in zooms
+        for emprise in emprises_tuiles(lon_min, lat_min, lon_max, lat_max, zoom)
+    ]
+    requetes = [p for p in requetes if not proxy.cache.contient(cle_requete(p))]
+
+    def charger(params):
+        try:
+            proxy.obtenir(params)
+            return True
+        except (urllib.error.URLError, TimeoutError):
+            return False
+
+    with ThreadPoolExecutor(max_workers=nb_threads) as executeur:
+        resultats = list(executeur.map(charger, requetes))
+    return sum(resultats), len(resultats)
+
+
+# Fonction de calcul de l'emprise WGS84 de chaque forêt à partir des observations
+def emprises_forets(df, marge=0.005):
+    coords = df.dropna(subset=["Forêt", "Coordonnée 1", "Coordonnée 2"])
+    groupes = coords.groupby("Forêt").agg(
+        lon_min=("Coordonnée 1", "min"), lat_min=("Coordonnée 2", "min"),
+        lon_max=("Coordonnée 1", "max"), lat_max=("Coordonnée 2", "max"),
+    )
+    groupes[["lon_min", "lat_min"]] -= marge
+    groupes[["lon_max", "lat_max"]] += marge
+    return {foret: tuple(ligne) for foret, ligne in groupes.iterrows()}
+
+
+# --------------------- LIGNE DE COMMANDE ---------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Proxy WMS avec cache disque pour la couche cadastre de l'IGN")
+    parser.add_argument("--hote", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--amont", default=WMS_IGN, help="URL du service WMS interrogé")
+    parser.add_argument("--cache", default=str(DOSSIER_CACHE), help="Dossier du cache disque")
+    parser.add_argument("--taille-max", type=int, default=TAILLE_MAX_CACHE // (1024 * 1024), help="Taille maximale du cache (Mo)")
+    parser.add_argument("--age-max", type=int, default=AGE_MAX_CACHE // (24 * 3600), help="Âge maximal d'une tuile (jours)")
+    parser.add_argument("--precharger", action="store_true", help="Pré-charger les tuiles de chaque forêt de MonExportBdn.xlsx")
+    parser.add_argument("--zooms", default=",".join(map(str, ZOOMS_PRECHARGEMENT)))
+    args = parser.parse_args()
+
+    cache = CacheTuiles(args.cache, args.taille_max * 1024 * 1024, args.age_max * 24 * 3600)
+    proxy = ProxyWMS(args.amont, cache)
+
+    if args.precharger:
+        import pandas as pd
+        df = pd.read_excel(Path(__file__).parent / "MonExportBdn.xlsx")
+        zooms = tuple(int(z) for z in args.zooms.split(","))
+        reussis, total = precharger_emprises(proxy, emprises_forets(df).values(), zooms)
+        print(f"Pré-chargement terminé : {reussis}/{total} tuiles récupérées")
+
+    serveur = ThreadingHTTPServer((args.hote, args.port), _gestionnaire(proxy))
+    print(f"Proxy cadastre en écoute sur http://{args.hote}:{args.port}/ (amont : {args.amont})")
+    serveur.serve_forever()
@@ -0,0 +1,199 @@
+# --------------------- IMPORTS ---------------------
+
+import bisect # classe d'enjeu d'une valeur isolée
+import hashlib # version du référentiel
+import math
+import json # historique des versions
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from observations import _colonnes_texte # colonnes texte homogènes pour l'écriture en parquet
+
+# --------------------- CONFIGURATION ---------------------
+
+FICHIER_REFERENTIEL = Path(__file__).parent / "Metadonnees.xlsx"
+
+# Dossier des versions successives du référentiel (un instantané parquet par version + historique)
+DOSSIER_VERSIONS = Path(__file__).parent / ".referentiel_versions"
+# Nombre de versions conservées (les instantanés plus anciens sont supprimés)
+NB_VERSIONS_CONSERVEES = 20
+
+# --------------------- FONCTIONS ---------------------
+
+# Fonction pour traduire les statuts codés en libellés compréhensibles
+def traduire_statut(statut):
+    traductions = {
+            "VU": "Vulnérable",
+            "EN": "En danger",
+            "CR": "En danger critique",
+            "NT": "Quasi menacé",
+            "LC": "Préoccupation mineure",
+            "DD": "Données insuffisantes",
+            "RE": "Éteint régionalement",
+            "NA": "Non applicable (Non indigène ou données occasionnelles)",
+            "NE": "Non évalué",
+            "DH IV": "Directive Habitats, Faune, Flore - Annexe IV",
+            "DH II&IV": "Directive Habitats, Faune, Flore - Annexe II & IV",
+            "DO I": "Directive Oiseaux - Annexe I",
+            "N.C." : "Non Concerné",
+            "PRA en cours" : "Plan régional d'action en cours",
+            "PNA en cours" : "Plan national d'action en cours",
+            "PRA en préparation" : "Plan régional d'action en préparation",
+            "PNA en préparation" : "Plan national d'action en préparation",
+            "PNG en cours" : "Plan national de gestion en cours",
+            "PRA en cours + PNA en préparation" : "Plan régional d'action en cours + Plan national d'action en préparation"}
+                    
+    return traductions.get(statut, statut) # Retourne le statut traduit ou le statut d'origine si non trouvé            
+
+
+# Classes d'enjeu selon l'indice global (bornes incluses à droite : 0-2, 4-8, 10-12, 14-16, 18-20) et couleurs associées
+classes_enjeu = ["Enjeu faible", "Enjeu modéré", "Enjeu élevé", "Enjeu fort", "Enjeu majeur"]
+bornes_enjeu = [0, 2, 8, 12, 16, 20]
+couleurs_enjeu = {
+    "Enjeu faible": '#92D050',  # vert
+    "Enjeu modéré": '#FFFF00',  # jaune
+    "Enjeu élevé": '#FFC000',  # orange
+    "Enjeu fort": '#FF0000',  # rouge
+    "Enjeu majeur": '#C00000',  # marron
+}
+
+
+# Fonction de calcul vectorisé de la classe d'enjeu (colonne catégorielle ordonnée, vide si l'indice n'est pas renseigné)
+def classer_enjeu(indices):
+    indices = pd.to_numeric(pd.Series(indices), errors="coerce")
+    return pd.cut(indices, bins=bornes_enjeu, labels=classes_enjeu, include_lowest=True, ordered=True)
+
+
+# Fonction de calcul de la classe d'enjeu d'une valeur isolée (mêmes bornes que classer_enjeu, None si non renseignée)
+def classe_enjeu(val):
+    try:
+        indice = float(val)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(indice) or not bornes_enjeu[0] <= indice <= bornes_enjeu[-1]:
+        return None
+    return classes_enjeu[max(bisect.bisect_left(bornes_enjeu, indice) - 1, 0)]
+
+
+#Fonction d'affichage du fond et des points naturalistes par couleur
+def get_indice_global_color(val):
+    classe = val if val in couleurs_enjeu else classe_enjeu(val)
+    return couleurs_enjeu.get(classe, '#ffffff')
+
+
+# Fonction de lecture du référentiel des espèces (CD_NOM nettoyés)
+def lire_referentiel(chemin=FICHIER_REFERENTIEL):
+    df_reference = pd.read_excel(chemin, keep_default_na=False)
+    df_reference['CD_NOM'] = df_reference['CD_NOM'].astype(str).str.strip()
+    return df_reference
+
+
+# Fonction listant les colonnes d'arrêtés de protection du référentiel : l'arrêté national puis les arrêtés
+# régionaux propres à chaque région (par exemple Arrêté_protection_BN et Arrêté_protection_HN en Normandie)
+def colonnes_protection(df_reference):
+    regionales = [c for c in df_reference.columns if c.startswith("Arrêté_protection_") and c != "Arrêté_protection_nationale"]
+    return ["Arrêté_protection_nationale"] * ("Arrêté_protection_nationale" in df_reference.columns) + regionales
+
+
+# Fonction de calcul de l'empreinte de chaque espèce (hachage vectorisé de toutes les colonnes de la ligne)
+def empreintes_especes(df_reference):
+    hachages = pd.util.hash_pandas_object(df_reference.astype(str), index=False)
+    return pd.Series(
+        [format(int(h), "016x") for h in hachages.to_numpy()],
+        index=df_reference['CD_NOM'].to_numpy(), name="empreinte",
+    )
+
+
+# Fonction de calcul d'une empreinte globale à partir d'empreintes d'espèces (indépendante de l'ordre des lignes)
+def empreinte_ensemble(empreintes):
+    contenu = "\n".join(f"{cd_nom}:{e}" for cd_nom, e in sorted(zip(empreintes.index, empreintes)))
+    return hashlib.sha1(contenu.encode("utf-8")).hexdigest()[:12]
+
+
+# Fonction de calcul de l'empreinte des seules espèces d'une sélection (forêt, parcelle...) :
+# elle ne change que si l'une de ces espèces est ajoutée, retirée ou modifiée dans le référentiel
+def empreinte_selection(empreintes, codes):
+    codes = pd.Index(pd.unique(pd.Series(codes, dtype=str)))
+    presentes = empreintes[empreintes.index.isin(codes)]
+    absentes = codes.difference(presentes.index)
+    return empreinte_ensemble(pd.concat([presentes, pd.Series("absente", index=absentes)]))
+
+
+# Fonction de calcul de la version du référentiel
+def version_referentiel(df_reference):
+    return empreinte_ensemble(empreintes_especes(df_reference))
+
+
+# Fonction de calcul de la version de quelques colonnes du référentiel seulement (par exemple l'indice global) :
+# les résultats qui n'utilisent que ces colonnes ne sont pas recalculés lorsqu'une autre colonne est corrigée
+def version_colonnes(df_reference, colonnes):
+    return empreinte_ensemble(empreintes_especes(df_reference[["CD_NOM", *colonnes]]))
+
+
+def _historique(dossier=DOSSIER_VERSIONS):
+    chemin = Path(dossier) / "historique.json"
+    if chemin.exists():
+        return json.loads(chemin.read_text(encoding="utf-8"))
+    return []
+
+
+def _chemin_version(version, dossier=DOSSIER_VERSIONS):
+    return Path(dossier) / f"{version}.parquet"
+
+
+# Fonction d'enregistrement d'un instantané du référentiel s'il s'agit d'une nouvelle version
+# (parquet, colonnes texte homogénéisées ; seules les NB_VERSIONS_CONSERVEES dernières versions sont gardées)
+def enregistrer_version(df_reference, dossier=DOSSIER_VERSIONS, nb_versions=NB_VERSIONS_CONSERVEES):
+    dossier = Path(dossier)
+    version = version_referentiel(df_reference)
+    historique = _historique(dossier)
+    nouvelle = not historique or historique[-1]["version"] != version
+    if nouvelle or not _chemin_version(version, dossier).exists():
+        dossier.mkdir(parents=True, exist_ok=True)
+        _colonnes_texte(df_reference).to_parquet(_chemin_version(version, dossier), index=False)
+    if nouvelle:
+        historique.append({"version": version, "date": datetime.now().isoformat(timespec="seconds"), "nb_especes": len(df_reference)})
+        anciennes, historique = historique[:-nb_versions], historique[-nb_versions:]
+        conservees = {v["version"] for v in historique}
+        for ancienne in anciennes:
+            if ancienne["version"] not in conservees:
+                _chemin_version(ancienne["version"], dossier).unlink(missing_ok=True)
+        (dossier / "historique.json").write_text(json.dumps(historique, indent=2), encoding="utf-8")
+    return version
+
+
+# Fonction de liste des versions enregistrées dont l'instantané est disponible (de la plus ancienne à la plus récente)
+def lister_versions(dossier=DOSSIER_VERSIONS):
+    return [v for v in _historique(dossier) if _chemin_version(v["version"], dossier).exists()]
+
+
+# Fonction de lecture d'un instantané du référentiel
+def lire_version(version, dossier=DOSSIER_VERSIONS):
+    return pd.read_parquet(_chemin_version(version, dossier))
+
+
+# Fonction de comparaison de deux versions du référentiel, espèce par espèce :
+# retourne les CD_NOM ajoutés, retirés et, pour chaque CD_NOM modifié, la liste des colonnes modifiées
+def differences(ancien, nouveau):
+    empreintes_ancien = empreintes_especes(ancien)
+    empreintes_nouveau = empreintes_especes(nouveau)
+    ajoutes = sorted(set(empreintes_nouveau.index) - set(empreintes_ancien.index))
+    retires = sorted(set(empreintes_ancien.index) - set(empreintes_nouveau.index))
+
+    communs = empreintes_nouveau.index.intersection(empreintes_ancien.index)
+    communs = communs[empreintes_nouveau[communs].to_numpy() != empreintes_ancien[communs].to_numpy()]
+    modifies = {}
+    if len(communs):
+        lignes_ancien = ancien.drop_duplicates('CD_NOM').set_index('CD_NOM').loc[communs].astype(str)
+        lignes_nouveau = nouveau.drop_duplicates('CD_NOM').set_index('CD_NOM').loc[communs].astype(str)
+        colonnes = lignes_nouveau.columns.intersection(lignes_ancien.columns)
+        ecarts = lignes_nouveau[colonnes] != lignes_ancien[colonnes]
+        modifies = {cd_nom: colonnes[ligne].tolist() for cd_nom, ligne in zip(communs, ecarts.to_numpy())}
+    return {"ajoutes": ajoutes, "retires": retires, "modifies": modifies}
+
+
+# Fonction retournant les CD_NOM concernés par un changement de référentiel
+def especes_modifiees(diff):
+    return set(diff["ajoutes"]) | set(diff["retires"]) | set(diff["modifies"])
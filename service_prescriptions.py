@@ -0,0 +1,239 @@
+# --------------------- IMPORTS ---------------------
+
+import argparse # options de la ligne de commande
+import gzip # compression des réponses
+import hmac # comparaison du jeton d'accès
+import json
+import os
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+import observations # ingestion des observations
+import referentiel # lecture et version du référentiel
+
+# --------------------- CONFIGURATION ---------------------
+
+# Intervalle minimal (secondes) entre deux vérifications de modification des fichiers sources
+INTERVALLE_VERIFICATION = 10
+
+# Taille minimale (octets) d'une réponse pour qu'elle soit compressée
+TAILLE_MIN_GZIP = 512
+
+# Adresses d'écoute locales : sans jeton, le service n'est accessible que depuis la machine elle-même
+HOTES_LOCAUX = ("127.0.0.1", "localhost", "::1")
+# Jeton d'accès partagé (en-tête "Authorization: Bearer <jeton>"), obligatoire si le service écoute sur le réseau
+JETON_SERVICE = os.environ.get("PRESCRIPTIONS_JETON")
+
+# Champs du référentiel servis pour chaque espèce
+CHAMPS_ESPECE = {
+    "cd_nom": "CD_NOM",
+    "nom_scientifique": "Nom_scientifique_valide",
+    "nom_vernaculaire": "Nom_vernaculaire",
+    "categorie": "Cat_naturaliste",
+    "indice_global": "Indice_global",
+    "code_unique": "Code_unique",
+    "condition_application": "Condition(s)_application_clause",
+    "role_tft": "Rôle_TFT",
+    "libelle_teck": "Libellé_fiche_chantier_ONF (TECK)",
+    "libelle_designation_mobile": "Libellé_fiche_désignation_ONF (DESIGNATION MOBILE)",
+    "libelle_production_bois": "Libellé_fiche_vente_ONF (PRODUCTION BOIS)",
+}
+
+# --------------------- FONCTIONS ---------------------
+
+def _valeur_json(val):
+    if pd.isna(val):
+        return None
+    if hasattr(val, "item"): # types numpy
+        return val.item()
+    return val
+
+
+# Fonction de construction de la fiche JSON d'une espèce (clauses et statuts traduits)
+def fiche_json(ligne):
+    fiche = {cle: _valeur_json(ligne.get(colonne)) for cle, colonne in CHAMPS_ESPECE.items()}
+    fiche["liste_rouge_regionale"] = referentiel.traduire_statut(ligne.get("LR_reg"))
+    fiche["liste_rouge_nationale"] = referentiel.traduire_statut(ligne.get("LR_nat"))
+    fiche["directives_europeennes"] = referentiel.traduire_statut(ligne.get("Directives_euro"))
+    fiche["plan_action"] = referentiel.traduire_statut(ligne.get("Plan_action"))
+    return fiche
+
+
+# Index en mémoire de toutes les réponses du service, reconstruit lorsque les fichiers sources changent.
+# Chaque réponse est sérialisée une fois ; sa version compressée est calculée à la première demande.
+# Avec une région, les observations et le référentiel sont lus dans le stockage partitionné de cette région.
+class IndexPrescriptions:
+    def __init__(self, region=None):
+        self.region = region
+        self._verrou = threading.Lock()
+        self._dates_sources = None
+        self._derniere_verification = 0
+        self.etag = None
+        self.reponses = {}
+        self._reponses_gzip = {}
+
+    def _dates_modification(self):
+        if self.region is not None:
+            return (observations.chemin_referentiel(self.region).stat().st_mtime, (observations.DOSSIER_DONNEES / "catalogue.parquet").stat().st_mtime)
+        return (referentiel.FICHIER_REFERENTIEL.stat().st_mtime, observations.FICHIER_OBSERVATIONS.stat().st_mtime)
+
+    # Rechargement si les fichiers sources ont changé (vérification au plus toutes les INTERVALLE_VERIFICATION secondes)
+    def actualiser(self):
+        if time.time() - self._derniere_verification < INTERVALLE_VERIFICATION:
+            return
+        with self._verrou:
+            self._derniere_verification = time.time()
+            dates = self._dates_modification()
+            if dates != self._dates_sources:
+                self._construire()
+                self._dates_sources = dates
+
+    def _construire(self):
+        if self.region is not None:
+            df_reference = referentiel.lire_referentiel(observations.chemin_referentiel(self.region)).drop_duplicates("CD_NOM")
+            df_observations = observations.lire_region(self.region)
+        else:
+            df_reference = referentiel.lire_referentiel().drop_duplicates("CD_NOM")
+            df_observations = observations.lire_observations()
+        codes_autorises = df_reference["CD_NOM"].tolist()
+        df, _ = observations.preparer(df_observations, codes_autorises)
+        df = df.dropna(subset=["Forêt"])
+        # Les observations d'espèces sensibles ne sont jamais diffusées par le service
+        if "Liste sensible" in df.columns:
+            df = df[df["Liste sensible"].astype(str).str.strip() != "Oui"]
+        df["Parcelle de forêt"] = df["Parcelle de forêt"].map(lambda p: "Non renseignée" if pd.isna(p) else str(p))
+
+        fiches = {ligne["CD_NOM"]: fiche_json(ligne) for ligne in df_reference.to_dict("records")}
+        reponses = {f"/especes/{cd_nom}": fiche for cd_nom, fiche in fiches.items()}
+        reponses["/especes"] = [{"cd_nom": f["cd_nom"], "nom_vernaculaire": f["nom_vernaculaire"], "code_unique": f["code_unique"]} for f in fiches.values()]
+
+        # Espèces par forêt et par parcelle (nombre d'observations, dernière date et clauses à inscrire)
+        synthese = df.groupby(["Forêt", "Parcelle de forêt", "Code taxon (cd_nom)"]).agg(
+            nb_observations=("Date_obs", "size"), derniere_observation=("Date_obs", "max"),
+        ).reset_index()
+
+        def especes(groupe):
+            lignes = groupe.groupby("Code taxon (cd_nom)").agg(
+                nb_observations=("nb_observations", "sum"), derniere_observation=("derniere_observation", "max"),
+            )
+            return [
+                {
+                    **{cle: fiches[cd_nom][cle] for cle in ("cd_nom", "nom_vernaculaire", "indice_global", "code_unique", "libelle_teck", "libelle_designation_mobile", "libelle_production_bois")},
+                    "nb_observations": int(ligne.nb_observations),
+                    "derniere_observation": None if pd.isna(ligne.derniere_observation) else ligne.derniere_observation.date().isoformat(),
+                }
+                for cd_nom, ligne in lignes.iterrows()
+            ]
+
+        reponses["/forets"] = sorted(synthese["Forêt"].unique().tolist())
+        for foret, groupe_foret in synthese.groupby("Forêt"):
+            parcelles = sorted(groupe_foret["Parcelle de forêt"].unique().tolist())
+            reponses[f"/forets/{foret}"] = {"foret": foret, "parcelles": parcelles, "especes": especes(groupe_foret)}
+            for parcelle, groupe_parcelle in groupe_foret.groupby("Parcelle de forêt"):
+                reponses[f"/forets/{foret}/parcelles/{parcelle}"] = {"foret": foret, "parcelle": parcelle, "especes": especes(groupe_parcelle)}
+
+        # L'ETag dépend de la version du référentiel et du jeu d'observations
+        version = referentiel.version_referentiel(df_reference)
+        self.etag = f'"{version}-{int(self._dates_modification()[1])}"'
+        self.reponses = {chemin: json.dumps(contenu, ensure_ascii=False).encode("utf-8") for chemin, contenu in reponses.items()}
+        self._reponses_gzip = {}
+
+    def reponse(self, chemin, gzip_accepte=False):
+        corps = self.reponses.get(chemin)
+        if corps is None or not gzip_accepte or len(corps) < TAILLE_MIN_GZIP:
+            return corps, False
+        compresse = self._reponses_gzip.get(chemin)
+        if compresse is None:
+            compresse = self._reponses_gzip[chemin] = gzip.compress(corps, compresslevel=6)
+        return compresse, True
+
+
+def _gestionnaire(index, jeton=None):
+    class Gestionnaire(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # connexions persistantes
+
+        def _envoyer(self, code, corps=b"", compresse=False):
+            self.send_response(code)
+            if index.etag:
+                self.send_header("ETag", index.etag)
+            self.send_header("Cache-Control", "no-cache") # le client revalide avec If-None-Match
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            if code != 304:
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+            if compresse:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(corps)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(corps)
+
+        def do_GET(self):
+            if jeton and not hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {jeton}"):
+                self._envoyer(401, json.dumps({"erreur": "Jeton d'accès manquant ou invalide"}, ensure_ascii=False).encode("utf-8"))
+                return
+            index.actualiser()
+            chemin = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).rstrip("/") or "/"
+            if chemin == "/":
+                chemin = "/forets"
+            if chemin not in index.reponses:
+                self._envoyer(404, json.dumps({"erreur": f"Ressource inconnue : {chemin}"}, ensure_ascii=False).encode("utf-8"))
+                return
+            # Réponse conditionnelle : rien à renvoyer si le client possède déjà cette version
+            if index.etag in [e.strip() for e in self.headers.get("If-None-Match", "").split(",")]:
+                self._envoyer(304)
+                return
+            gzip_accepte = "gzip" in self.headers.get("Accept-Encoding", "")
+            corps, compresse = index.reponse(chemin, gzip_accepte)
+            self._envoyer(200, corps, compresse)
+
+        do_HEAD = do_GET
+
+        def log_message(self, format, *args):
+            pass
+
+    return Gestionnaire
+
+
+# Fonction de vérification de l'accès : un service écoutant sur le réseau doit être protégé par un jeton
+def verifier_acces(hote, jeton):
+    if hote not in HOTES_LOCAUX and not jeton:
+        raise ValueError(f"Un jeton d'accès (PRESCRIPTIONS_JETON ou --jeton) est obligatoire pour écouter sur {hote}")
+
+
+# Fonction de démarrage du service dans un thread (retourne le serveur pour pouvoir l'arrêter)
+def demarrer_service(hote="127.0.0.1", port=8766, jeton=JETON_SERVICE, region=None):
+    verifier_acces(hote, jeton)
+    index = IndexPrescriptions(region)
+    index.actualiser()
+    serveur = ThreadingHTTPServer((hote, port), _gestionnaire(index, jeton))
+    serveur.daemon_threads = True
+    serveur.index = index
+    threading.Thread(target=serveur.serve_forever, daemon=True).start()
+    return serveur
+
+
+# --------------------- LIGNE DE COMMANDE ---------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Service JSON de consultation des prescriptions par espèce, forêt et parcelle")
+    parser.add_argument("--hote", default="127.0.0.1", help="Adresse d'écoute (0.0.0.0 pour le réseau, jeton obligatoire)")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--jeton", default=JETON_SERVICE, help="Jeton d'accès attendu dans l'en-tête Authorization: Bearer <jeton>")
+    parser.add_argument("--region", help="Région du stockage partitionné (par défaut : fichiers à la racine du dépôt)")
+    args = parser.parse_args()
+
+    try:
+        verifier_acces(args.hote, args.jeton)
+    except ValueError as erreur:
+        parser.error(str(erreur))
+    index = IndexPrescriptions(args.region)
+    index.actualiser()
+    serveur = ThreadingHTTPServer((args.hote, args.port), _gestionnaire(index, args.jeton))
+    print(f"Service des prescriptions en écoute sur http://{args.hote}:{args.port}/")
+    print("  /especes, /especes/<CD_NOM>, /forets, /forets/<forêt>, /forets/<forêt>/parcelles/<parcelle>")
+    serveur.serve_forever()
@@ -0,0 +1,154 @@
+# --------------------- IMPORTS ---------------------
+
+import hashlib # nom des fichiers de résultats
+import itertools
+import os
+import shutil
+import threading # file de tâches en arrière-plan
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor # pool de travailleurs
+from pathlib import Path
+
+# --------------------- CONFIGURATION ---------------------
+
+# Dossier des fichiers produits par les tâches d'export (vidé au démarrage de la file)
+DOSSIER_EXPORTS = Path(__file__).parent / ".exports"
+
+# Paramètres par défaut de la file : nombre de travailleurs et taille du cache des résultats terminés
+NB_TRAVAILLEURS = 2
+NB_MAX_RESULTATS = 32
+TAILLE_MAX_RESULTATS = 500 * 1024 * 1024 # 500 Mo
+# Durée (secondes) pendant laquelle un résultat récemment affiché n'est pas évincé,
+# pour que les boutons de téléchargement déjà affichés dans les sessions restent valides
+DELAI_CONSERVATION = 600
+
+# États d'une tâche
+EN_ATTENTE = "en attente"
+EN_COURS = "en cours"
+TERMINEE = "terminée"
+ECHEC = "échec"
+
+# --------------------- FONCTIONS ---------------------
+
+# Tâche d'export : état, avancement et fichier produit (lu par les sessions qui demandent le même export)
+class Tache:
+    def __init__(self, cle, libelle):
+        self.cle = cle
+        self.libelle = libelle
+        self.etat = EN_ATTENTE
+        self.progression = 0.0
+        self.message = "En attente d'un travailleur"
+        self.chemin = None
+        self.taille = 0
+        self.erreur = None
+        self.soumission = time.time()
+        self.dernier_acces = self.soumission
+        self.fin = None
+
+    # Mise à jour de l'avancement (appelée par la fonction d'export, fraction entre 0 et 1)
+    def avancer(self, fraction, message=None):
+        self.progression = min(max(float(fraction), 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+    @property
+    def active(self):
+        return self.etat in (EN_ATTENTE, EN_COURS)
+
+    # Résultat terminé dont le fichier existe encore
+    @property
+    def disponible(self):
+        return self.etat == TERMINEE and self.chemin is not None and self.chemin.exists()
+
+    def lire(self):
+        with open(self.chemin, "rb") as f:
+            return f.read()
+
+
+# File de tâches d'export exécutées par un pool de travailleurs :
+# une demande identique à une tâche en cours ou terminée réutilise cette tâche (clé de la demande),
+# les résultats terminés sont conservés dans un cache borné en nombre et en taille (éviction des moins récemment demandés)
+class FileTaches:
+    def __init__(self, dossier=DOSSIER_EXPORTS, nb_travailleurs=NB_TRAVAILLEURS, nb_max=NB_MAX_RESULTATS, taille_max=TAILLE_MAX_RESULTATS, delai_conservation=DELAI_CONSERVATION):
+        self.dossier = Path(dossier)
+        shutil.rmtree(self.dossier, ignore_errors=True)
+        self.dossier.mkdir(parents=True, exist_ok=True)
+        self.nb_max = nb_max
+        self.taille_max = taille_max
+        self.delai_conservation = delai_conservation
+        self._verrou = threading.Lock()
+        self._taches = OrderedDict() # de la moins à la plus récemment demandée
+        self._numeros = itertools.count()
+        self._executeur = ThreadPoolExecutor(max_workers=nb_travailleurs, thread_name_prefix="export")
+
+    # Tâche correspondant à une clé (None si elle n'a jamais été demandée ou a été évincée)
+    def tache(self, cle):
+        with self._verrou:
+            tache = self._taches.get(cle)
+            if tache is not None:
+                self._taches.move_to_end(cle)
+                tache.dernier_acces = time.time()
+            return tache
+
+    # Soumission d'un export : fonction(*args, avancer=..., **kwargs) retourne du texte (enregistré en UTF-8),
+    # des octets ou un fichier ouvert ; avec vers_fichier=True, elle écrit directement dans le fichier du résultat
+    # reçu en argument destination (aucune copie intermédiaire).
+    # Une tâche en échec ou dont le fichier a disparu est relancée, sinon la tâche existante est retournée.
+    def soumettre(self, cle, libelle, fonction, *args, vers_fichier=False, **kwargs):
+        with self._verrou:
+            tache = self._taches.get(cle)
+            if tache is not None and (tache.active or tache.disponible):
+                self._taches.move_to_end(cle)
+                tache.dernier_acces = time.time()
+                return tache
+            tache = self._taches[cle] = Tache(cle, libelle)
+        self._executeur.submit(self._executer, tache, fonction, args, kwargs, vers_fichier)
+        return tache
+
+    def _executer(self, tache, fonction, args, kwargs, vers_fichier=False):
+        tache.etat = EN_COURS
+        tache.avancer(0, "Démarrage")
+        nom = hashlib.sha1(repr(tache.cle).encode("utf-8")).hexdigest()[:16]
+        chemin = self.dossier / f"{nom}-{next(self._numeros)}.export"
+        temporaire = chemin.with_suffix(".tmp")
+        try:
+            if vers_fichier:
+                fonction(*args, avancer=tache.avancer, destination=temporaire, **kwargs)
+            else:
+                resultat = fonction(*args, avancer=tache.avancer, **kwargs)
+                if isinstance(resultat, str):
+                    resultat = resultat.encode("utf-8")
+                with open(temporaire, "wb") as f:
+                    if isinstance(resultat, (bytes, bytearray)):
+                        f.write(resultat)
+                    else:
+                        with resultat:
+                            shutil.copyfileobj(resultat, f)
+            os.replace(temporaire, chemin)
+            tache.chemin, tache.taille = chemin, chemin.stat().st_size
+            tache.avancer(1, "Terminé")
+            tache.etat = TERMINEE
+        except Exception as erreur:
+            temporaire.unlink(missing_ok=True)
+            tache.erreur = f"{type(erreur).__name__} : {erreur}"
+            tache.etat = ECHEC
+        tache.fin = time.time()
+        self.evincer()
+
+    # Suppression des résultats terminés (ou en échec) les moins récemment demandés au-delà des limites,
+    # hormis ceux demandés depuis moins de delai_conservation secondes (limites dépassées temporairement)
+    def evincer(self):
+        with self._verrou:
+            limite = time.time() - self.delai_conservation
+            finies = [t for t in self._taches.values() if not t.active]
+            nb, taille = len(finies), sum(t.taille for t in finies)
+            for tache in finies:
+                if nb <= self.nb_max and taille <= self.taille_max:
+                    break
+                if tache.dernier_acces >= limite:
+                    continue
+                del self._taches[tache.cle]
+                nb, taille = nb - 1, taille - tache.taille
+                if tache.chemin is not None:
+                    tache.chemin.unlink(missing_ok=True)